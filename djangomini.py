@@ -1,19 +1,22 @@
 #/usr/bin/env python
-from optparse import Option, OptionParser, BadOptionError
+from optparse import Option, OptionParser, BadOptionError, OptionValueError
+import atexit
 import hashlib
 import logging
 import imp
 import os
 import re
+import select
+import shlex
+import struct
 import string
 import sys
+import threading
+import time
 import types
 import urllib
 
 
-logging.basicConfig(loglevel=logging.INFO)
-
-
 try:
     from urlparse import parse_qsl
 except ImportError:
@@ -24,6 +27,17 @@ try:
 except ImportError:
     from urllib import unquote_plus
 
+try:
+    from queue import Queue, Empty, Full
+except ImportError:
+    from Queue import Queue, Empty, Full
+
+try:
+    text_type = unicode
+except NameError:
+    # Python 3
+    text_type = str
+
 
 __version__ = '0.5.1'
 BACKENDS = {
@@ -32,6 +46,12 @@ BACKENDS = {
     'sqlite': 'django.db.backends.sqlite3',
     'oracle': 'django.db.backends.oracle',
 }
+# Statement prefixes for showing a query plan, by BACKENDS name.
+EXPLAIN_PREFIXES = {
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+}
 DJANGO_SETTINGS = {
     'DEBUG': True,
     'INTERNAL_IPS': ('127.0.0.1',),
@@ -61,8 +81,28 @@ CUSTOM_APPS = {
         ],
         'DEBUG': True,
     },
+    'metrics': {
+        'MIDDLEWARE_CLASSES': ['djangomini.MetricsMiddleware'],
+    },
+    'access-log': {
+        'MIDDLEWARE_CLASSES': ['djangomini.AccessLogMiddleware'],
+    },
+    'coalesce': {
+        'MIDDLEWARE_CLASSES': ['djangomini.CoalesceMiddleware'],
+    },
+    'concurrency': {
+        'MIDDLEWARE_CLASSES': ['djangomini.ConcurrencyLimitMiddleware'],
+    },
 }
 _rooturlconf = 'djangominiurlconf'
+_metrics_url = 'metrics/'
+_log_writer = None
+_slow_queries = None
+_tasks = {}
+_task_model = None
+_task_table_lock = threading.Lock()
+_task_table_exists = False
+access_logger = logging.getLogger('djangomini.access')
 
 
 class DjangoOptionParser(OptionParser):
@@ -95,6 +135,19 @@ def add_app_name(option, opt_str, value, parser):
     parser.values.apps.append((name, prefix))
 
 
+def add_concurrency_limit(option, opt_str, value, parser):
+    """Call-back for the --concurrency option and OptionParser."""
+    # Limits are for app names. Unlike --app, there is no URL prefix.
+    name, sep, limit = value.partition(':')
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise OptionValueError('%s needs APPNAME:N, not %r' % (opt_str, value))
+    if not name or limit < 1:
+        raise OptionValueError('%s needs APPNAME:N, not %r' % (opt_str, value))
+    parser.values.concurrency[name] = limit
+
+
 def make_parser():
     parser = DjangoOptionParser(version='%prog ' + __version__,
         usage='usage: %prog [options] command')
@@ -111,6 +164,41 @@ def make_parser():
         help='use %s instead of an in-memory database' % PERSISTING_DATABASE)
     parser.add_option('--debug-toolbar', default=False, action='store_true',
         help='sets DEBUG=True and activates django-debug-toolbar if present')
+    parser.add_option('--metrics', default=False, action='store_true',
+        help='record request metrics and serve them at /%s' % _metrics_url)
+    parser.add_option('--log-file', metavar='FILE',
+        help='write log messages to FILE instead of stderr')
+    parser.add_option('--log-queue-size', type='int', default=10000, metavar='N',
+        help='drop log messages when more than N are waiting [default: %default]')
+    parser.add_option('--access-log', default=False, action='store_true',
+        help='log each request as JSON')
+    parser.add_option('--explain-slow', type='float', metavar='MS',
+        help='save the query plan of queries taking longer than MS milliseconds')
+    parser.add_option('--explain-file', default='slow-queries.json', metavar='FILE',
+        help='file for the --explain-slow report [default: %default]')
+    parser.add_option('--explain-analyze', default=False, action='store_true',
+        help='use EXPLAIN ANALYZE for --explain-slow with PostgreSQL')
+    parser.add_option('--workers', type='int', default=0, metavar='N',
+        help='serve the site with N forked worker processes instead of a command')
+    parser.add_option('--bind', default='127.0.0.1:8000', metavar='HOST:PORT',
+        help='address for --workers to listen on [default: %default]')
+    parser.add_option('--warmup', action='append', default=[], metavar='URL',
+        help='request URL in the parent process before forking --workers')
+    parser.add_option('--coalesce', action='append', default=[], metavar='APPNAME',
+        help='share one response between identical concurrent GET requests to an app')
+    parser.add_option('--concurrency', action='callback', default={},
+        type='string', callback=add_concurrency_limit, metavar='APPNAME:N',
+        help='handle at most N requests to an app at once, rejecting the rest')
+    parser.add_option('--export', action='append', default=[], metavar='APPNAME',
+        help="serve an app's models as streamed JSON and CSV at /export/")
+    parser.add_option('--task-workers', type='int', default=0, metavar='N',
+        help='run background tasks in N threads alongside the command')
+    parser.add_option('--watch-apps', default=False, action='store_true',
+        help='only reload runserver for changes to the --app packages')
+    parser.add_option('--batch', metavar='FILE',
+        help='run each command listed in FILE (or - for stdin) in turn')
+    parser.add_option('--batch-continue', default=False, action='store_true',
+        help='keep running batch commands after one fails')
 
     return parser
 
@@ -236,15 +324,84 @@ def main(argv):
         sys.stderr.write('%s.\nHave you installed Django?\n' % str(err))
         sys.exit(1)
 
-    options, django_options, arguments = parse_args(argv[1:])
+    profile = profile_filename(argv[1:])
+    loaded = profile and load_profile(profile)
+    if loaded:
+        options, settings, arguments = loaded
+    else:
+        options, django_options, arguments = parse_args(argv[1:])
+
+        # At least one argument, else we see Django's help instead of our own.
+        if not (arguments or options.batch or options.workers):
+            make_parser().print_help()
+            sys.exit(2)
+
+        if options.batch and arguments:
+            make_parser().error('--batch runs the commands in FILE, so it'
+                ' cannot be used with a command on the command line')
+
+        settings = make_settings(options, django_options)
+        if profile:
+            save_profile(profile, options, settings, arguments)
+
+    configure_logging(options.log_file, options.log_queue_size)
+    configure_settings(settings)
+    install_commands()
+
+    if options.explain_slow is not None:
+        install_slow_query_log(options.explain_slow, options.explain_file,
+            options.explain_analyze)
+
+    urlpatterns = make_urlpatterns(options.apps)
+    if options.admin:
+        # Force /admin/ first in the patterns.
+        urlpatterns = make_admin_urlpatterns() + urlpatterns
+    if options.metrics:
+        urlpatterns = make_metrics_urlpatterns() + urlpatterns
+    if options.export:
+        urlpatterns = make_export_urlpatterns(options.export) + urlpatterns
+
+    configure_urlconf(urlpatterns)
+
+    # The runserver process that watches for changes doesn't serve requests.
+    if options.task_workers and not is_reloader_parent(arguments):
+        create_task_table()
+        start_task_workers(options.task_workers)
+
+    if options.watch_apps:
+        install_app_reloader([name for name, prefix in options.apps])
+
+    if options.workers:
+        host, sep, port = options.bind.rpartition(':')
+        serve_prefork(host or '127.0.0.1', int(port), options.workers, options.warmup)
+    elif options.batch:
+        if options.batch == '-':
+            commands = read_batch(sys.stdin)
+        else:
+            fh = open(options.batch)
+            try:
+                commands = read_batch(fh)
+            finally:
+                fh.close()
+
+        # The autoreloader restarts by running the whole command line again,
+        # which would repeat the commands before runserver.
+        for argv in commands:
+            if argv[0] == 'runserver' and '--noreload' not in argv:
+                make_parser().error('runserver in a batch needs --noreload')
+
+        failures = run_batch(commands, stop_on_error=not options.batch_continue)
+        if failures:
+            sys.exit(1)
+    else:
+        execute_from_command_line(['django-mini'] + arguments)
+
+
+def make_settings(options, django_options):
+    """Returns the settings dictionary for the parsed command line."""
     settings = dict(DJANGO_SETTINGS)
     settings.update(django_options)
 
-    # At least one argument, else we see Django's help instead of our own.
-    if not arguments:
-        make_parser().print_help()
-        sys.exit(2)
-
     if options.persisting and (options.database == DEFAULT_DATABASE):
         options.database = PERSISTING_DATABASE
 
@@ -259,15 +416,168 @@ def main(argv):
     if options.admin:
         add_custom_app('admin', settings)
 
-    configure_settings(settings)
-
-    urlpatterns = make_urlpatterns(options.apps)
+    if options.access_log:
+        add_custom_app('access-log', settings)
+
+    if options.metrics:
+        add_custom_app('metrics', settings)
+
+    if options.coalesce:
+        add_custom_app('coalesce', settings)
+        settings.setdefault('COALESCE_APPS', options.coalesce)
+
+    if options.concurrency:
+        add_custom_app('concurrency', settings)
+        # Turn requests away before any other middleware does any work.
+        middleware = settings['MIDDLEWARE_CLASSES']
+        middleware.remove('djangomini.ConcurrencyLimitMiddleware')
+        middleware.insert(0, 'djangomini.ConcurrencyLimitMiddleware')
+        limits = options.concurrency
+        # Each worker process has its own limits, so they share the total.
+        if options.workers > 1:
+            limits = dict((app, max(1, limit // options.workers))
+                for app, limit in limits.items())
+        settings.setdefault('CONCURRENCY_LIMITS', limits)
+
+    mounts = list(options.apps)
     if options.admin:
-        # Force /admin/ first in the patterns.
-        urlpatterns = make_admin_urlpatterns() + urlpatterns
+        mounts.append(('django.contrib.admin', 'admin'))
+    settings.setdefault('APP_MOUNTS', mounts)
 
-    configure_urlconf(urlpatterns)
-    execute_from_command_line(['django-mini'] + arguments)
+    return settings
+
+
+def profile_filename(args):
+    """Returns the name of the launch profile for the command line
+    arguments, or None if DJANGOMINI_PROFILE_DIR is not set.
+    """
+    import django
+
+    directory = os.environ.get('DJANGOMINI_PROFILE_DIR')
+    if not directory:
+        return None
+
+    # Settings depend on this module and the versions too, and marshal's
+    # format can change. The module's size and modification time stand in
+    # for its source, which may have changed without a new version number.
+    module_stat = os.stat(__file__)
+    module_key = '%s:%d:%r' % (__file__, module_stat.st_size, module_stat.st_mtime)
+    key = [module_key, repr(django.VERSION), repr(sys.version_info[:2])] + list(args)
+    digest = hashlib.md5('\0'.join(key).encode('utf-8')).hexdigest()
+    return os.path.join(directory, 'djangomini-%s.profile' % digest)
+
+
+def save_profile(filename, options, settings, arguments):
+    """Saves the parsed options, settings and Django arguments. Does nothing
+    if a setting value can't be saved.
+    """
+    import marshal
+
+    try:
+        data = marshal.dumps((vars(options), settings, arguments))
+    except ValueError:
+        return
+
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    fh = open(tmp_filename, 'wb')
+    try:
+        fh.write(data)
+    finally:
+        fh.close()
+    os.rename(tmp_filename, filename)
+
+
+def load_profile(filename):
+    """Returns a triple of options, settings and Django arguments from a
+    saved profile, or None if there is no usable profile.
+    """
+    import marshal
+    from optparse import Values
+
+    try:
+        fh = open(filename, 'rb')
+    except IOError:
+        return None
+    try:
+        try:
+            options, settings, arguments = marshal.load(fh)
+        except (EOFError, ValueError, TypeError):
+            return None
+    finally:
+        fh.close()
+
+    return Values(options), settings, arguments
+
+
+def read_batch(lines):
+    """Returns a list of argument lists, one for each command line. Blank
+    lines and lines starting with '#' are skipped.
+    """
+    commands = []
+    for line in lines:
+        args = shlex.split(line, comments=True)
+        if args:
+            commands.append(args)
+
+    return commands
+
+
+def run_batch_command(argv):
+    """Runs a single Django management command in this process. The first
+    item of argv is the command name, the rest are its options and arguments.
+    """
+    from django.core.management import call_command, get_commands, load_command_class
+    from django.core.management.base import CommandError
+
+    name, args = argv[0], argv[1:]
+    try:
+        app_name = get_commands()[name]
+    except KeyError:
+        raise CommandError('Unknown command: %r' % name)
+
+    command = load_command_class(app_name, name)
+
+    # Use the command's own parser so options are handled as on the command line.
+    parser = command.create_parser('django-mini', name)
+    opts, args = parser.parse_args(args)
+    call_command(name, *args, **vars(opts))
+
+
+def run_batch(commands, stop_on_error=True):
+    """Runs each command in the list of argument lists, writing the time
+    taken by each to stderr. Returns the number of commands that failed.
+    """
+    failures = 0
+    for argv in commands:
+        line = ' '.join(argv)
+        start = time.time()
+        err = None
+        try:
+            run_batch_command(argv)
+        # Commands such as 'test' and '--help' end with sys.exit().
+        except SystemExit:
+            code = sys.exc_info()[1].code
+            # The autoreloader's exit status asking for a restart.
+            if code == 3:
+                raise
+            if code:
+                err = 'exit status %s' % code
+        except Exception:
+            err = sys.exc_info()[1]
+
+        if err is not None:
+            failures += 1
+            sys.stderr.write('%r failed after %.3fs: %s\n'
+                % (line, time.time() - start, err))
+            if stop_on_error:
+                break
+        else:
+            sys.stderr.write('%r finished in %.3fs\n' % (line, time.time() - start))
+
+    return failures
 
 
 def configure_urlconf(patterns):
@@ -282,6 +592,14 @@ def configure_urlconf(patterns):
     settings.ROOT_URLCONF = _rooturlconf
 
 
+def is_reloader_parent(arguments):
+    """Returns True if the Django command is runserver and this process
+    only restarts the server when code changes.
+    """
+    return (arguments[:1] == ['runserver'] and '--noreload' not in arguments
+        and os.environ.get('RUN_MAIN') != 'true')
+
+
 def configure_settings(kwargs):
     """Sets up Django's settings module."""
     from django.conf import settings
@@ -324,5 +642,1946 @@ def make_admin_urlpatterns():
     return patterns('', url(r'^admin/', include(admin.site.urls)))
 
 
+def make_metrics_urlpatterns():
+    """Returns a patterns() list serving the metrics view."""
+    try:
+        from django.conf.urls import patterns, url
+    except ImportError:
+        # Django 1.3
+        from django.conf.urls.defaults import patterns, url
+
+    return patterns('', url(r'^%s$' % _metrics_url, metrics_view))
+
+
+class MetricsRegistry(object):
+    """Thread-safe counters, gauges and histograms, rendered in Prometheus
+    text format.
+
+    If a directory is given, each process periodically writes its values to a
+    file there and render() adds up the values from every process.
+    """
+    buckets = {
+        'djangomini_request_duration_seconds': (0.005, 0.01, 0.025, 0.05,
+            0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+        'djangomini_response_size_bytes': (100, 1000, 10000, 100000,
+            1000000, 10000000),
+        'djangomini_db_queries': (0, 1, 2, 5, 10, 20, 50, 100),
+    }
+    metric_types = {
+        'djangomini_requests_total': 'counter',
+        'djangomini_requests_in_flight': 'gauge',
+        'djangomini_coalesced_requests_total': 'counter',
+        'djangomini_rejected_requests_total': 'counter',
+        'djangomini_concurrency_limit': 'gauge',
+    }
+
+    def __init__(self, directory=None, flush_interval=1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.values = {}
+        self.lock = threading.Lock()
+        self.last_flush = 0
+
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        self.lock.acquire()
+        try:
+            self.values[key] = self.values.get(key, 0) + amount
+        finally:
+            self.lock.release()
+
+    def set(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        self.lock.acquire()
+        try:
+            self.values[key] = value
+        finally:
+            self.lock.release()
+
+    def observe(self, name, labels, value):
+        labels = tuple(sorted(labels.items()))
+        self.lock.acquire()
+        try:
+            # Buckets are cumulative, and every bucket is always present.
+            for bound in self.buckets[name] + ('+Inf',):
+                key = (name + '_bucket', labels + (('le', str(bound)),))
+                hit = bound == '+Inf' or value <= bound
+                self.values[key] = self.values.get(key, 0) + int(hit)
+            for suffix, amount in (('_sum', value), ('_count', 1)):
+                key = (name + suffix, labels)
+                self.values[key] = self.values.get(key, 0) + amount
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            return dict(self.values)
+        finally:
+            self.lock.release()
+
+    def filename(self, pid=None):
+        return os.path.join(self.directory, 'metrics-%d.json' % (pid or os.getpid()))
+
+    def flush(self, force=False):
+        """Writes this process's values to its file, at most once every
+        flush_interval seconds unless forced.
+        """
+        import json
+
+        now = time.time()
+        if not self.directory or (not force and now - self.last_flush < self.flush_interval):
+            return
+        self.last_flush = now
+
+        data = [[name, labels, value] for (name, labels), value in self.snapshot().items()]
+        filename = self.filename()
+        tmp_filename = '%s.%d.tmp' % (filename, threading.current_thread().ident)
+        fh = open(tmp_filename, 'w')
+        try:
+            json.dump(data, fh)
+        finally:
+            fh.close()
+        os.rename(tmp_filename, filename)
+
+    def reset(self):
+        """Forgets all values recorded by this process."""
+        self.lock.acquire()
+        try:
+            self.values.clear()
+        finally:
+            self.lock.release()
+        self.remove_file()
+
+    def remove_file(self):
+        """Removes this process's file, so its values stop being counted."""
+        if self.directory:
+            try:
+                os.remove(self.filename())
+            except OSError:
+                pass
+
+    def collect(self):
+        """Returns the values for all processes."""
+        import json
+
+        values = self.snapshot()
+        if not self.directory or not os.path.isdir(self.directory):
+            return values
+
+        own_filename = self.filename()
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            match = _metrics_filename.match(filename)
+            if not match or path == own_filename:
+                continue
+            # Files left by processes that have gone would be counted forever.
+            if not _process_exists(int(match.group(1))):
+                continue
+            try:
+                fh = open(path)
+                try:
+                    data = json.load(fh)
+                finally:
+                    fh.close()
+            except (IOError, ValueError):
+                continue
+            for name, labels, value in data:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                values[key] = values.get(key, 0) + value
+
+        return values
+
+    def render(self):
+        """Returns the values in Prometheus text exposition format."""
+        families = {}
+        for (name, labels), value in self.collect().items():
+            family = name
+            for suffix in ('_bucket', '_sum', '_count'):
+                if name.endswith(suffix) and name[:-len(suffix)] in self.buckets:
+                    family = name[:-len(suffix)]
+            families.setdefault(family, []).append((name, labels, value))
+
+        lines = []
+        for family in sorted(families):
+            lines.append('# TYPE %s %s' % (family, self.metric_types.get(family, 'histogram')))
+            for name, labels, value in sorted(families[family], key=_metric_sort_key):
+                label_str = ','.join('%s="%s"' % (k, _escape_label(v)) for k, v in labels)
+                lines.append('%s{%s} %s' % (name, label_str, _format_metric(value)))
+
+        return '\n'.join(lines) + '\n'
+
+
+_metrics_filename = re.compile(r'^metrics-(\d+)\.json$')
+
+
+def _process_exists(pid):
+    """Returns True if there is a process with the pid."""
+    import errno
+
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        # EPERM means it exists but belongs to someone else.
+        return sys.exc_info()[1].errno == errno.EPERM
+    return True
+
+
+def _metric_sort_key(item):
+    name, labels, value = item
+    labels = dict(labels)
+    le = labels.pop('le', None)
+    le = float(le) if le is not None else 0
+    return (name, sorted(labels.items()), le)
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_metric(value):
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+_metrics = MetricsRegistry()
+
+
+def find_mount(path, mounts):
+    """Returns the (app, prefix) pair that serves the URL path. The longest
+    matching prefix wins.
+    """
+    path = path.lstrip('/')
+    for app, prefix in sorted(mounts, key=lambda mount: -len(mount[1])):
+        if not prefix or path == prefix or path.startswith(prefix + '/'):
+            return app, prefix
+
+    return '', ''
+
+
+class MetricsMiddleware(object):
+    """Records request count, latency, response size, database queries and
+    requests in flight for each (app, prefix) mount.
+    """
+    def __init__(self):
+        from django.conf import settings
+
+        self.mounts = getattr(settings, 'APP_MOUNTS', [])
+        _metrics.directory = getattr(settings, 'METRICS_DIR', None)
+        if _metrics.directory:
+            if not os.path.isdir(_metrics.directory):
+                os.makedirs(_metrics.directory)
+            atexit.register(_metrics.remove_file)
+
+    def process_request(self, request):
+        from django.db import connection
+
+        if request.path == '/' + _metrics_url:
+            return None
+
+        app, prefix = find_mount(request.path, self.mounts)
+        request._metrics_labels = {'app': app, 'prefix': prefix}
+        request._metrics_queries = len(connection.queries)
+        request._metrics_start = time.time()
+        _metrics.inc('djangomini_requests_in_flight', request._metrics_labels)
+
+    def process_response(self, request, response):
+        from django.db import connection
+
+        labels = getattr(request, '_metrics_labels', None)
+        if labels is None:
+            return response
+
+        duration = time.time() - request._metrics_start
+        _metrics.inc('djangomini_requests_in_flight', labels, -1)
+        _metrics.observe('djangomini_request_duration_seconds', labels, duration)
+
+        size = response_size(response)
+        if size is not None:
+            _metrics.observe('djangomini_response_size_bytes', labels, size)
+
+        # Django only records queries when DEBUG is True.
+        queries = len(connection.queries) - request._metrics_queries
+        _metrics.observe('djangomini_db_queries', labels, max(queries, 0))
+
+        status_labels = dict(labels, method=request.method, status=response.status_code)
+        _metrics.inc('djangomini_requests_total', status_labels)
+        _metrics.flush()
+
+        return response
+
+
+def make_export_urlpatterns(names):
+    """Returns a patterns() list serving exports of the named apps' models at
+    /export/<app_label>/<model_name>.<json|csv>.
+    """
+    try:
+        from django.conf.urls import patterns, url
+    except ImportError:
+        # Django 1.3
+        from django.conf.urls.defaults import patterns, url
+
+    urls = []
+    for name in names:
+        app_label = name.split('.')[-1]
+        pattern = r'^export/(?P<app_label>%s)/(?P<model_name>\w+)\.(?P<format>json|csv)$'
+        urls.append(url(pattern % re.escape(app_label), export_view))
+
+    return patterns('', *urls)
+
+
+def iter_rows(queryset, fields, after=None, chunk_size=1000):
+    """Yields tuples of field values for each row of the queryset, in
+    primary key order. Rows are fetched chunk_size at a time, each chunk
+    starting after the last primary key of the one before, so that every
+    query is quick however far through the table it is.
+    """
+    pk_name = queryset.model._meta.pk.attname
+    # The primary key is needed to find the next chunk.
+    with_pk = pk_name not in fields
+    names = [pk_name] + list(fields) if with_pk else list(fields)
+    pk_index = names.index(pk_name)
+
+    while True:
+        chunk = queryset.order_by(pk_name)
+        if after is not None:
+            chunk = chunk.filter(pk__gt=after)
+        count = 0
+        for row in chunk.values_list(*names)[:chunk_size].iterator():
+            count += 1
+            after = row[pk_index]
+            yield row[1:] if with_pk else row
+        if count < chunk_size:
+            break
+
+
+def stream_json(fields, rows):
+    """Yields a JSON array of objects, one for each row."""
+    from django.core.serializers.json import DjangoJSONEncoder
+
+    encoder = DjangoJSONEncoder()
+    yield '['
+    separator = ''
+    for row in rows:
+        yield separator + encoder.encode(dict(zip(fields, row)))
+        separator = ',\n'
+    yield ']\n'
+
+
+class _LineBuffer(object):
+    """A file-like object for csv.writer that keeps the last line written."""
+    def write(self, value):
+        self.line = value
+
+
+def stream_csv(fields, rows):
+    """Yields CSV lines, starting with a header of field names."""
+    import csv
+
+    buf = _LineBuffer()
+    writer = csv.writer(buf)
+    writer.writerow(_csv_values(fields))
+    yield buf.line
+    for row in rows:
+        writer.writerow(_csv_values(row))
+        yield buf.line
+
+
+def _csv_values(values):
+    # Python 2's csv module can't write unicode.
+    if sys.version_info[0] < 3:
+        return [v.encode('utf-8') if isinstance(v, text_type) else v for v in values]
+    return values
+
+
+def export_view(request, app_label, model_name, format):
+    """Streams every row of a model as JSON or CSV. Use the 'after' query
+    parameter to start after a primary key.
+    """
+    from django.conf import settings
+    from django.core.exceptions import ValidationError
+    from django.db.models import get_model
+    from django.http import Http404, HttpResponseBadRequest
+    try:
+        from django.http import StreamingHttpResponse
+    except ImportError:
+        # Django 1.3 and 1.4 stream an HttpResponse made with an iterator.
+        from django.http import HttpResponse as StreamingHttpResponse
+
+    model = get_model(app_label, model_name)
+    if model is None:
+        raise Http404('No model %s.%s' % (app_label, model_name))
+
+    after = request.GET.get('after')
+    if after is not None:
+        try:
+            after = model._meta.pk.to_python(after)
+        except ValidationError:
+            return HttpResponseBadRequest('after must be a %s primary key.\n' %
+                model._meta.object_name, content_type='text/plain')
+
+    fields = [f.attname for f in model._meta.fields]
+    chunk_size = getattr(settings, 'EXPORT_CHUNK_SIZE', 1000)
+    rows = iter_rows(model._default_manager.all(), fields, after, chunk_size)
+
+    if format == 'csv':
+        response = StreamingHttpResponse(stream_csv(fields, rows), content_type='text/csv')
+    else:
+        response = StreamingHttpResponse(stream_json(fields, rows),
+            content_type='application/json')
+    response['Content-Disposition'] = 'attachment; filename=%s.%s' % (
+        model._meta.db_table, format)
+
+    return response
+
+
+class _Flight(object):
+    """A request being handled, that identical requests can wait for."""
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+        self.started = time.time()
+
+
+class CoalesceMiddleware(object):
+    """Lets one of several identical concurrent GET or HEAD requests make
+    the response, and gives a copy of it to the others.
+
+    Requests are identical if they have the same method, path, query string
+    and the headers named in the COALESCE_VARY_HEADERS setting. Only requests
+    for the apps named in the COALESCE_APPS setting are coalesced. A waiting
+    request gives up after COALESCE_TIMEOUT seconds and makes its own response.
+    """
+    vary_headers = ('Accept', 'Accept-Encoding', 'Accept-Language',
+        'Authorization', 'Cookie')
+
+    def __init__(self):
+        from django.conf import settings
+
+        self.mounts = getattr(settings, 'APP_MOUNTS', [])
+        self.apps = getattr(settings, 'COALESCE_APPS', [])
+        self.timeout = getattr(settings, 'COALESCE_TIMEOUT', 10)
+        self.vary_headers = getattr(settings, 'COALESCE_VARY_HEADERS', self.vary_headers)
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def request_key(self, request):
+        headers = [request.META.get('HTTP_' + h.upper().replace('-', '_'), '')
+            for h in self.vary_headers]
+        return (request.method, request.path,
+            request.META.get('QUERY_STRING', '')) + tuple(headers)
+
+    def process_request(self, request):
+        if request.method not in ('GET', 'HEAD'):
+            return None
+        app, prefix = find_mount(request.path, self.mounts)
+        if app not in self.apps:
+            return None
+
+        key = self.request_key(request)
+        self.lock.acquire()
+        try:
+            flight = self.flights.get(key)
+            # A flight older than the timeout has lost its request somehow.
+            if flight is None or time.time() - flight.started > self.timeout:
+                request._coalesce_key = key
+                self.flights[key] = _Flight()
+                return None
+        finally:
+            self.lock.release()
+
+        flight.event.wait(self.timeout)
+        labels = {'app': app, 'prefix': prefix}
+        if flight.event.is_set() and flight.response is not None:
+            _metrics.inc('djangomini_coalesced_requests_total', dict(labels, result='shared'))
+            return copy_response(flight.response)
+
+        result = 'timeout' if not flight.event.is_set() else 'unshareable'
+        _metrics.inc('djangomini_coalesced_requests_total', dict(labels, result=result))
+        return None
+
+    def process_response(self, request, response):
+        key = getattr(request, '_coalesce_key', None)
+        if key is None:
+            return response
+
+        self.lock.acquire()
+        try:
+            flight = self.flights.pop(key, None)
+        finally:
+            self.lock.release()
+
+        if flight is not None:
+            # Streamed content can only be read once, and cookies belong to
+            # the request that set them.
+            if not is_streaming(response) and not response.cookies:
+                flight.response = response
+            flight.event.set()
+
+        return response
+
+
+def copy_response(response):
+    """Returns a new response with the same status, headers and content."""
+    from django.http import HttpResponse
+
+    copy = HttpResponse(response.content, status=response.status_code)
+    for header, value in response.items():
+        copy[header] = value
+
+    return copy
+
+
+class ConcurrencyLimiter(object):
+    """Admits at most limit callers at once. Others wait in a queue of
+    queue_size for up to timeout seconds.
+
+    The limit adapts to latency: it shrinks when requests get much slower
+    than the quickest seen recently, and grows back towards max_limit.
+    """
+    def __init__(self, max_limit, queue_size, timeout):
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.min_latency = None
+        self.avg_latency = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Returns True if the caller may go ahead, False if it is rejected."""
+        self.condition.acquire()
+        try:
+            if self.active < int(self.limit):
+                self.active += 1
+                return True
+            if self.waiting >= self.queue_size:
+                return False
+
+            self.waiting += 1
+            try:
+                deadline = time.time() + self.timeout
+                while self.active >= int(self.limit):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+        finally:
+            self.condition.release()
+
+    def release(self, latency):
+        self.condition.acquire()
+        try:
+            self.active -= 1
+            self.avg_latency = 0.9 * self.avg_latency + 0.1 * latency
+            # Let the quickest latency drift up, so it follows the app.
+            if self.min_latency is None or latency < self.min_latency:
+                self.min_latency = latency
+            else:
+                self.min_latency *= 1.001
+
+            if latency > 2 * self.min_latency and latency > 0.001:
+                self.limit = max(1.0, self.limit * 0.9)
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def retry_after(self):
+        """Returns the seconds a rejected caller should wait before retrying."""
+        queued = self.active + self.waiting
+        return max(1, int(round(self.avg_latency * queued / max(self.limit, 1))))
+
+
+class ConcurrencyLimitMiddleware(object):
+    """Limits the number of requests each app handles at once, set by the
+    CONCURRENCY_LIMITS setting, a dictionary of app names and limits.
+
+    Requests over the limit wait in a queue of CONCURRENCY_QUEUE_SIZE requests
+    (by default the same as the limit) for up to CONCURRENCY_TIMEOUT seconds.
+    Requests that can't wait get a 503 response with a Retry-After header.
+
+    The limits are for this process only.
+    """
+    def __init__(self):
+        from django.conf import settings
+        from django.core.signals import request_finished
+
+        self.mounts = getattr(settings, 'APP_MOUNTS', [])
+        self.local = threading.local()
+        queue_size = getattr(settings, 'CONCURRENCY_QUEUE_SIZE', None)
+        timeout = getattr(settings, 'CONCURRENCY_TIMEOUT', 1.0)
+        self.limiters = {}
+        for app, limit in getattr(settings, 'CONCURRENCY_LIMITS', {}).items():
+            size = limit if queue_size is None else queue_size
+            self.limiters[app] = ConcurrencyLimiter(limit, size, timeout)
+        request_finished.connect(self.request_finished)
+
+    def process_request(self, request):
+        from django.http import HttpResponse
+
+        app, prefix = find_mount(request.path, self.mounts)
+        limiter = self.limiters.get(app)
+        if limiter is None:
+            return None
+
+        labels = {'app': app, 'prefix': prefix}
+        if not limiter.acquire():
+            _metrics.inc('djangomini_rejected_requests_total', labels)
+            response = HttpResponse('Service unavailable, please try again later.\n',
+                content_type='text/plain', status=503)
+            response['Retry-After'] = str(limiter.retry_after())
+            return response
+
+        request._concurrency = self.local.admitted = (limiter, labels, time.time())
+        return None
+
+    def process_response(self, request, response):
+        admitted = getattr(request, '_concurrency', None)
+        if admitted is not None:
+            del request._concurrency
+            self.release(admitted)
+
+        return response
+
+    def request_finished(self, **kwargs):
+        # process_response isn't called when another middleware's
+        # process_response raises an exception first.
+        admitted = getattr(self.local, 'admitted', None)
+        if admitted is not None:
+            self.release(admitted)
+
+    def release(self, admitted):
+        limiter, labels, start = admitted
+        if getattr(self.local, 'admitted', None) is admitted:
+            self.local.admitted = None
+        limiter.release(time.time() - start)
+        _metrics.set('djangomini_concurrency_limit', labels, int(limiter.limit))
+
+
+def response_size(response):
+    """Returns the size of the response content, or None for a streaming
+    response without a Content-Length header.
+    """
+    size = response.get('Content-Length')
+    if size is not None:
+        return int(size)
+    if not is_streaming(response):
+        return len(response.content)
+
+
+def is_streaming(response):
+    """Returns True if reading the response content would consume it."""
+    import django
+
+    if getattr(response, 'streaming', False):
+        return True
+    if django.VERSION[:2] >= (1, 5):
+        return False
+    # Django 1.3 and 1.4 stream an HttpResponse made with an iterator.
+    return (getattr(response, '_base_content_is_iter', False)
+        or not getattr(response, '_is_string', True))
+
+
+def metrics_view(request):
+    """Serves the recorded metrics in Prometheus text format."""
+    from django.http import HttpResponse
+
+    _metrics.flush(force=True)
+    return HttpResponse(_metrics.render(), content_type='text/plain; version=0.0.4')
+
+
+def get_wsgi_application():
+    """Returns Django's WSGI application."""
+    try:
+        from django.core.wsgi import get_wsgi_application
+    except ImportError:
+        # Django 1.3
+        from django.core.handlers.wsgi import WSGIHandler
+        return WSGIHandler()
+
+    return get_wsgi_application()
+
+
+def _read_kb_values(filename):
+    """Returns a dictionary of the 'Name: N kB' lines in a /proc file, with
+    lower case names. Returns an empty dictionary if there is no such file.
+    """
+    values = {}
+    try:
+        fh = open(filename)
+    except IOError:
+        return values
+
+    try:
+        for line in fh:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                values[parts[0].rstrip(':').lower()] = int(parts[1])
+    finally:
+        fh.close()
+
+    return values
+
+
+def memory_usage():
+    """Returns a dictionary of this process's memory use in kilobytes. On
+    Linux 'rss' is the memory in use and 'private' the memory not shared
+    with other processes. Elsewhere only the largest the memory in use has
+    been, 'peak_rss', is known.
+    """
+    usage = _read_kb_values('/proc/self/smaps_rollup')
+    if usage:
+        usage['private'] = usage.get('private_clean', 0) + usage.get('private_dirty', 0)
+        return usage
+
+    # Linux before 4.14 has no smaps_rollup.
+    status = _read_kb_values('/proc/self/status')
+    if 'vmrss' in status:
+        return {'rss': status['vmrss']}
+
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS counts bytes, other systems kilobytes.
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return {'peak_rss': peak}
+
+
+def format_memory_usage(usage):
+    names = [name for name in ('rss', 'pss', 'private', 'peak_rss') if name in usage]
+    return ' '.join('%s=%dkB' % (name, usage[name]) for name in names)
+
+
+def warm_up(application, urls):
+    """Requests each URL from the WSGI application in this process."""
+    from wsgiref.util import setup_testing_defaults
+
+    for url in urls:
+        path, sep, query = url.partition('?')
+        environ = {'PATH_INFO': path, 'QUERY_STRING': query}
+        setup_testing_defaults(environ)
+        status = []
+
+        def start_response(status_line, headers, exc_info=None):
+            status.append(status_line)
+            return lambda data: None
+
+        start = time.time()
+        result = application(environ, start_response)
+        try:
+            for chunk in result:
+                pass
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        sys.stderr.write('Warm-up %s %s in %.3fs\n'
+            % (url, status and status[0], time.time() - start))
+
+
+def serve_prefork(host, port, workers, warmup_urls=()):
+    """Loads the site in this process then forks worker processes to serve
+    it. Anything loaded before the fork is shared copy-on-write.
+    """
+    import gc
+    import signal
+    from wsgiref.simple_server import make_server
+    from django.db import connections
+
+    application = get_wsgi_application()
+    warm_up(application, warmup_urls)
+
+    # Connections can't be shared with the workers.
+    for connection in connections.all():
+        connection.close()
+
+    # Warm-up requests aren't traffic, and workers would otherwise inherit
+    # and count them again.
+    _metrics.reset()
+
+    server = make_server(host, port, application)
+    gc.collect()
+    # Stops the garbage collector touching (and so copying) preloaded objects.
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+    sys.stderr.write('Parent %d %s\n' % (os.getpid(), format_memory_usage(memory_usage())))
+    sys.stderr.write('Serving on http://%s:%d/ with %d workers\n' % (host, port, workers))
+
+    children = []
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            before = memory_usage()
+
+            restart_log_writer()
+
+            def stop(signum, frame):
+                # Both the parent and the process group may signal us.
+                signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                sys.stderr.write('Worker %d before %s, after %s\n' % (os.getpid(),
+                    format_memory_usage(before), format_memory_usage(memory_usage())))
+                stop_log_writer()
+                os._exit(0)
+
+            signal.signal(signal.SIGTERM, stop)
+            signal.signal(signal.SIGINT, stop)
+            server.serve_forever()
+            os._exit(0)
+        children.append(pid)
+
+    def stop_children(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop_children)
+    signal.signal(signal.SIGINT, stop_children)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError:
+            # Interrupted by a signal.
+            continue
+        if pid in children:
+            children.remove(pid)
+
+    server.server_close()
+
+
+class QueueHandler(logging.Handler):
+    """Puts log records on a bounded queue for a LogWriter thread. Records
+    are dropped and counted if the queue is full.
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The message arguments may have changed by the time the record is
+        # written, so merge them now.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Full:
+            self.dropped += 1
+        except Exception:
+            # Such as a bad format string, reported like other handlers do.
+            self.handleError(record)
+
+
+class LogWriter(threading.Thread):
+    """Writes the records from a queue to a stream, as many as batch_size
+    records at a time.
+    """
+    def __init__(self, queue, stream, formatter, batch_size=100, close_stream=False):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.stream = stream
+        self.formatter = formatter
+        self.batch_size = batch_size
+        self.close_stream = close_stream
+
+    def run(self):
+        running = True
+        while running:
+            records = [self.queue.get()]
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self.queue.get_nowait())
+                except Empty:
+                    break
+
+            # None is the signal to stop.
+            running = None not in records
+            lines = [self.formatter.format(r) + '\n' for r in records if r is not None]
+            if lines:
+                self.stream.write(''.join(lines))
+                self.stream.flush()
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+
+def configure_logging(filename=None, queue_size=10000, level=logging.INFO):
+    """Sends log records to a writer thread, so that writing them doesn't
+    hold up the thread that logged them. Returns the QueueHandler.
+    """
+    global _log_writer
+
+    # Replace any earlier configuration.
+    stop_log_writer()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, QueueHandler):
+            root.removeHandler(handler)
+
+    stream = open(filename, 'a') if filename else sys.stderr
+    handler = QueueHandler(Queue(queue_size))
+    formatter = logging.Formatter('%(levelname)s:%(name)s:%(message)s')
+    _log_writer = LogWriter(handler.queue, stream, formatter,
+        close_stream=bool(filename))
+    _log_writer.start()
+
+    root.addHandler(handler)
+    root.setLevel(level)
+    atexit.register(stop_log_writer)
+
+    return handler
+
+
+def restart_log_writer():
+    """Starts a new writer thread in a forked process. Threads don't survive
+    fork(), so the records would otherwise never be written.
+    """
+    global _log_writer
+
+    if _log_writer is None:
+        return
+
+    writer = _log_writer
+    queue = Queue(writer.queue.maxsize)
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, QueueHandler) and handler.queue is writer.queue:
+            handler.queue = queue
+    _log_writer = LogWriter(queue, writer.stream, writer.formatter, writer.batch_size,
+        writer.close_stream)
+    _log_writer.start()
+
+
+def stop_log_writer():
+    """Writes any waiting records and stops the writer thread."""
+    global _log_writer
+
+    writer, _log_writer = _log_writer, None
+    if writer is None:
+        return
+    if writer.is_alive():
+        writer.stop()
+    if writer.close_stream:
+        writer.stream.close()
+
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, QueueHandler) and handler.dropped:
+            sys.stderr.write('Dropped %d log messages\n' % handler.dropped)
+
+
+class AccessLogMiddleware(object):
+    """Logs each request as a JSON object to the 'djangomini.access' logger."""
+    def process_request(self, request):
+        request._access_log_start = time.time()
+
+    def process_response(self, request, response):
+        import json
+
+        start = getattr(request, '_access_log_start', None)
+        if start is None:
+            return response
+
+        entry = {
+            'time': start,
+            'duration_ms': round((time.time() - start) * 1000, 3),
+            'method': request.method,
+            'path': request.path,
+            'query': request.META.get('QUERY_STRING', ''),
+            'status': response.status_code,
+            'size': response_size(response),
+            'remote_addr': request.META.get('REMOTE_ADDR'),
+        }
+        access_logger.info(json.dumps(entry, sort_keys=True))
+
+        return response
+
+
+def install_commands():
+    """Adds django-mini's own management commands to Django's commands.
+
+    Django imports a command from <app>.management.commands.<name>, so the
+    commands are put in sys.modules as if djangomini were a package with
+    those modules.
+    """
+    from django.core.management import get_commands
+
+    for name in ['djangomini.management', 'djangomini.management.commands']:
+        sys.modules.setdefault(name, types.ModuleType(name))
+
+    # The dict of commands is cached, mapping each name to its app.
+    commands = get_commands()
+    for name, make_command in [('seed', make_seed_command), ('worker', make_worker_command)]:
+        module = types.ModuleType('djangomini.management.commands.' + name)
+        module.Command = make_command()
+        sys.modules[module.__name__] = module
+        commands.setdefault(name, 'djangomini')
+
+
+def make_seed_command():
+    """Returns the class of the 'seed' management command."""
+    from optparse import make_option
+    from django.core.management.base import BaseCommand, CommandError
+
+    class Command(BaseCommand):
+        help = ('Fills the models of the given apps (or every app added with'
+            ' --app) with generated data.')
+        args = '[appname ...]'
+        option_list = BaseCommand.option_list + (
+            make_option('--rows', type='int', default=1000,
+                help='number of rows to create for each model [default: %default]'),
+            make_option('--batch-size', type='int', default=1000,
+                help='number of rows to insert at a time [default: %default]'),
+            make_option('--processes', type='int', default=1,
+                help='number of processes inserting rows [default: %default]'),
+            make_option('--random-seed', type='int', default=0,
+                help='seed for the random data [default: %default]'),
+        )
+
+        def handle(self, *app_labels, **options):
+            # Not imported before the command runs, so registering it
+            # doesn't load the ORM.
+            from django.conf import settings
+            from django.db.models import get_app, get_models
+
+            if not app_labels:
+                app_labels = [name.split('.')[-1] for name in settings.INSTALLED_APPS
+                    if not name.startswith('django.')]
+
+            models = []
+            for label in app_labels:
+                models.extend(get_models(get_app(label)))
+
+            try:
+                seed_models(models, options['rows'], options['batch_size'],
+                    options['processes'], options['random_seed'])
+            except ValueError:
+                raise CommandError(str(sys.exc_info()[1]))
+
+    return Command
+
+
+def make_worker_command():
+    """Returns the class of the 'worker' management command."""
+    from optparse import make_option
+    from django.core.management.base import BaseCommand
+
+    class Command(BaseCommand):
+        help = 'Runs background tasks until interrupted.'
+        option_list = BaseCommand.option_list + (
+            make_option('--threads', type='int', default=1,
+                help='number of threads running tasks [default: %default]'),
+            make_option('--batch-size', type='int', default=10,
+                help='number of tasks each thread takes at a time [default: %default]'),
+            make_option('--poll-interval', type='float', default=1.0,
+                help='seconds to wait when there are no tasks [default: %default]'),
+            make_option('--burst', default=False, action='store_true',
+                help='stop when there are no tasks waiting'),
+            make_option('--lease', type='float', default=300,
+                help='seconds before a running task is given to another worker'
+                    ' [default: %default]'),
+        )
+
+        def handle(self, *args, **options):
+            create_task_table()
+            workers = start_task_workers(options['threads'], options['batch_size'],
+                options['poll_interval'], options['burst'], options['lease'])
+            try:
+                # Joining with a timeout lets KeyboardInterrupt through.
+                while [w for w in workers if w.is_alive()]:
+                    for worker in workers:
+                        worker.join(0.5)
+            except KeyboardInterrupt:
+                for worker in workers:
+                    worker.stop()
+                for worker in workers:
+                    worker.join()
+
+    return Command
+
+
+def _sort_models(models):
+    """Returns the models ordered so that each comes after the models its
+    foreign keys point to.
+    """
+    ordered = []
+    pending = list(models)
+    while pending:
+        for model in pending:
+            targets = [f.rel.to for f in model._meta.fields
+                if f.rel and f.rel.to in pending and f.rel.to is not model]
+            if not targets:
+                break
+        else:
+            # A cycle. Whichever model goes first must allow nulls.
+            model = pending[0]
+        pending.remove(model)
+        ordered.append(model)
+
+    return ordered
+
+
+def _random_string(rng, length):
+    return ''.join(rng.choice(string.ascii_lowercase) for i in range(length))
+
+
+# The largest values the integer fields can hold.
+_integer_limits = {
+    'SmallIntegerField': 32767,
+    'PositiveSmallIntegerField': 32767,
+    'IntegerField': 2147483647,
+    'PositiveIntegerField': 2147483647,
+    'BigIntegerField': 9223372036854775807,
+}
+
+
+def _too_many_rows(field, index):
+    return ValueError('Too many rows (%d) for unique %s.%s' % (index + 1,
+        field.model._meta.object_name, field.name))
+
+
+def fake_value(field, rng, index, related_pks=None, unique=None):
+    """Returns a generated value for a model field. index is the number of
+    the row, used to make values for unique fields. unique overrides the
+    field's own unique attribute.
+    """
+    import datetime
+    import decimal
+
+    kind = field.get_internal_type()
+    if unique is None:
+        unique = field.unique
+
+    if field.rel:
+        pks = related_pks.get(field.rel.to) if related_pks else None
+        if not pks:
+            if field.null:
+                return None
+            raise ValueError('No %s rows for %s.%s' % (field.rel.to._meta.object_name,
+                field.model._meta.object_name, field.name))
+        if unique:
+            if index >= len(pks):
+                raise ValueError('Not enough %s rows for unique %s.%s' % (
+                    field.rel.to._meta.object_name, field.model._meta.object_name,
+                    field.name))
+            return pks[index]
+        return rng.choice(pks)
+
+    if field.choices:
+        return rng.choice([value for value, label in field.flatchoices])
+
+    if kind in ('CharField', 'SlugField', 'TextField', 'FilePathField',
+            'FileField', 'ImageField'):
+        max_length = field.max_length or 200
+        value = _random_string(rng, min(max_length, rng.randint(5, 20)))
+        if unique:
+            suffix = '-%d' % index
+            value = value[:max_length - len(suffix)] + suffix
+        return value
+    if kind == 'EmailField':
+        return 'user%d-%s@example.com' % (index, _random_string(rng, 5))
+    if kind == 'URLField':
+        return 'http://example.com/%d/%s/' % (index, _random_string(rng, 5))
+    if kind in ('IPAddressField', 'GenericIPAddressField'):
+        return '10.%d.%d.%d' % (index >> 16 & 255, index >> 8 & 255, index & 255)
+
+    if kind in _integer_limits:
+        if not unique:
+            return rng.randint(0, 32767)
+        if index > _integer_limits[kind]:
+            raise _too_many_rows(field, index)
+        return index
+    if kind == 'FloatField':
+        return index + rng.random() if unique else rng.random() * 1000
+    if kind == 'DecimalField':
+        digits = min(field.max_digits - field.decimal_places, 6)
+        if unique:
+            if index >= 10 ** (field.max_digits - field.decimal_places):
+                raise _too_many_rows(field, index)
+            return decimal.Decimal(index)
+        value = rng.randint(0, 10 ** (digits + field.decimal_places) - 1)
+        return decimal.Decimal(value).scaleb(-field.decimal_places)
+    if kind in ('BooleanField', 'NullBooleanField'):
+        return rng.random() < 0.5
+
+    if kind in ('DateTimeField', 'DateField', 'TimeField'):
+        now = datetime.datetime(2013, 1, 1)
+        value = now - datetime.timedelta(seconds=rng.randint(0, 365 * 24 * 3600))
+        if unique:
+            # Each row a day apart for dates, a second apart otherwise.
+            if kind == 'DateField':
+                if index >= now.toordinal():
+                    raise _too_many_rows(field, index)
+                value = now - datetime.timedelta(days=index)
+            elif kind == 'TimeField' and index >= 24 * 3600:
+                raise _too_many_rows(field, index)
+            else:
+                value = now - datetime.timedelta(seconds=index)
+        if kind == 'DateField':
+            return value.date()
+        if kind == 'TimeField':
+            return value.time()
+        return _make_aware(value)
+
+    if field.has_default():
+        return field.get_default()
+    if field.null:
+        return None
+    raise ValueError('Cannot make data for %s.%s (%s)' % (
+        field.model._meta.object_name, field.name, kind))
+
+
+def _make_aware(value):
+    """Returns the datetime in UTC if time zone support is on."""
+    from django.conf import settings
+
+    if getattr(settings, 'USE_TZ', False):
+        from django.utils import timezone
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def _batch_random(random_seed, model, batch):
+    """Returns a random generator for a batch of rows, seeded so that the
+    data is the same however many processes make it.
+    """
+    import random
+
+    key = '%s:%s:%d' % (random_seed, model._meta.db_table, batch)
+    return random.Random(int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16))
+
+
+def _unique_together(model):
+    """Returns the names of fields that must have a different value in every
+    row for the model's unique_together constraints to hold, and a list of
+    groups of foreign keys whose combination must be different in every row.
+    """
+    fields = dict((f.name, f) for f in model._meta.fields)
+    unique_names = set()
+    key_groups = []
+    for names in model._meta.unique_together:
+        group = [fields[name] for name in names if name in fields]
+        # One field with a different value in every row is enough.
+        simple = [f for f in group if not f.rel and not f.choices]
+        if simple:
+            unique_names.add(simple[0].name)
+        else:
+            key_groups.append([f for f in group if f.rel])
+
+    return unique_names, key_groups
+
+
+def _key_combination(model, group, index, related_pks):
+    """Returns a dict of values for a group of foreign keys, different for
+    every index.
+    """
+    values = {}
+    remaining = index
+    for field in group:
+        pks = related_pks.get(field.rel.to) if related_pks else None
+        if not pks:
+            raise ValueError('No %s rows for %s.%s' % (field.rel.to._meta.object_name,
+                model._meta.object_name, field.name))
+        values[field.attname] = pks[remaining % len(pks)]
+        remaining //= len(pks)
+    if remaining:
+        raise ValueError('Not enough related rows for unique %s.%s' % (
+            model._meta.object_name, ', '.join(f.name for f in group)))
+
+    return values
+
+
+def make_objects(model, start, count, rng, related_pks=None):
+    """Returns a list of unsaved model instances with generated data."""
+    fields = [f for f in model._meta.fields if f.get_internal_type() != 'AutoField']
+    unique_names, key_groups = _unique_together(model)
+    objects = []
+    for index in range(start, start + count):
+        values = {}
+        for field in fields:
+            unique = field.unique or field.name in unique_names
+            values[field.attname] = fake_value(field, rng, index, related_pks, unique)
+        for group in key_groups:
+            values.update(_key_combination(model, group, index, related_pks))
+        objects.append(model(**values))
+
+    return objects
+
+
+def _insert_batches(model, batches, offset, rows, batch_size, random_seed, related_pks):
+    for batch in batches:
+        start = batch * batch_size
+        count = min(batch_size, rows - start)
+        rng = _batch_random(random_seed, model, batch)
+        objects = make_objects(model, offset + start, count, rng, related_pks)
+        if hasattr(model._default_manager, 'bulk_create'):
+            model._default_manager.bulk_create(objects)
+        else:
+            # Django 1.3
+            for obj in objects:
+                obj.save()
+
+
+def seed_models(models, rows, batch_size=1000, processes=1, random_seed=0):
+    """Inserts generated rows for each model, in batches. With more than one
+    process the batches are shared between forked processes.
+    """
+    from django.db import connections
+
+    related_pks = {}
+
+    for model in _sort_models(models):
+        # Rows added to an existing table get new values for unique fields.
+        offset = model._default_manager.count()
+        for target in set(f.rel.to for f in model._meta.fields if f.rel):
+            if target not in related_pks or target is model:
+                related_pks[target] = list(
+                    target._default_manager.values_list('pk', flat=True))
+
+        start = time.time()
+        batches = list(range((rows + batch_size - 1) // batch_size))
+        if processes <= 1:
+            _insert_batches(model, batches, offset, rows, batch_size, random_seed, related_pks)
+        else:
+            for connection in connections.all():
+                connection.close()
+            children = []
+            for i in range(processes):
+                pid = os.fork()
+                if pid == 0:
+                    # Never return to the parent's code, whatever happens.
+                    status = 1
+                    try:
+                        restart_log_writer()
+                        try:
+                            _insert_batches(model, batches[i::processes], offset, rows,
+                                batch_size, random_seed, related_pks)
+                            status = 0
+                        except Exception:
+                            logging.exception('Failed to seed %s', model._meta.object_name)
+                        stop_log_writer()
+                    finally:
+                        os._exit(status)
+                children.append(pid)
+            for pid in children:
+                pid, status = os.waitpid(pid, 0)
+                if status:
+                    raise ValueError('Failed to seed %s' % model._meta.object_name)
+
+        # Read the keys again for the models that refer to this one.
+        related_pks.pop(model, None)
+        sys.stderr.write('Created %d %s rows in %.3fs\n'
+            % (rows, model._meta.object_name, time.time() - start))
+
+
+_sql_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_sql_lists = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+
+
+def normalize_sql(sql):
+    """Returns the SQL with literal values and placeholders replaced by '?',
+    so that queries differing only in their values are the same.
+    """
+    sql = _sql_literals.sub('?', sql).replace('%s', '?')
+    sql = _sql_lists.sub('(...)', sql)
+    return ' '.join(sql.split())
+
+
+def backend_name(engine):
+    """Returns the BACKENDS name for a database ENGINE setting."""
+    for name, backend in BACKENDS.items():
+        if backend == engine:
+            return name
+    return engine
+
+
+class SlowQueryCursor(object):
+    """Wraps a database cursor, timing each query."""
+    def __init__(self, cursor, alias, log):
+        self.cursor = cursor
+        self.alias = alias
+        self.log = log
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, sql, params=()):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.log.record(self.alias, sql, params, time.time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.log.record(self.alias, sql, None, time.time() - start)
+
+
+class SlowQueryLog(object):
+    """Collects queries slower than threshold seconds and writes their query
+    plans to a JSON report, one entry per normalized SQL statement.
+
+    The plans are made by flush(), so that running EXPLAIN doesn't slow down
+    the query that was captured. A process forked after the log was made
+    writes its own report, with its process ID added to the filename.
+    """
+    def __init__(self, threshold, filename, analyze=False):
+        self.threshold = threshold
+        self.base_filename = self.filename = filename
+        self.analyze = analyze
+        self.pid = os.getpid()
+        self.entries = {}
+        self.pending = []
+        self.lock = threading.Lock()
+        # Held while updating the entries and writing the report.
+        self.flush_lock = threading.Lock()
+        self.local = threading.local()
+
+    def record(self, alias, sql, params, duration):
+        if duration < self.threshold or getattr(self.local, 'explaining', False):
+            return
+        self.lock.acquire()
+        try:
+            self._check_fork()
+            self.pending.append((alias, sql, params, duration))
+        finally:
+            self.lock.release()
+
+    def _check_fork(self):
+        # Called holding the lock. After a fork the queries so far are the
+        # parent's to report.
+        pid = os.getpid()
+        if pid != self.pid:
+            self.pid = pid
+            self.entries = {}
+            self.pending = []
+            root, ext = os.path.splitext(self.base_filename)
+            self.filename = '%s.%d%s' % (root, pid, ext)
+
+    def explain(self, alias, sql, params):
+        """Returns the rows of the query plan, using a separate connection.
+        Returns None if the query can't be explained.
+        """
+        from django.db import connections
+
+        connection = connections[alias]
+        backend = backend_name(connection.settings_dict['ENGINE'])
+        prefix = EXPLAIN_PREFIXES.get(backend)
+        if self.analyze and backend == 'postgresql':
+            prefix = 'EXPLAIN ANALYZE '
+        # Only SELECT is safe, because EXPLAIN ANALYZE runs the query.
+        if prefix is None or params is None or not sql.lstrip().upper().startswith('SELECT'):
+            return None
+
+        # An in-memory database only exists for the connection that made it.
+        in_memory = backend == 'sqlite' and connection.settings_dict['NAME'] in ('', ':memory:')
+        if in_memory:
+            explain_connection = connection
+        else:
+            explain_connection = connection.__class__(connection.settings_dict, alias)
+
+        self.local.explaining = True
+        try:
+            cursor = explain_connection.cursor()
+            cursor.execute(prefix + sql, params)
+            return [[str(column) for column in row] for row in cursor.fetchall()]
+        except Exception:
+            return ['EXPLAIN failed: %s' % sys.exc_info()[1]]
+        finally:
+            self.local.explaining = False
+            if not in_memory:
+                explain_connection.close()
+
+    def flush(self, **kwargs):
+        """Explains the queries captured since the last flush and writes the
+        report. Can be connected to the request_finished signal.
+        """
+        self.lock.acquire()
+        try:
+            self._check_fork()
+            pending, self.pending = self.pending, []
+        finally:
+            self.lock.release()
+        if not pending:
+            return
+
+        self.flush_lock.acquire()
+        try:
+            self._write(pending)
+        finally:
+            self.flush_lock.release()
+
+    def _write(self, pending):
+        import json
+
+        for alias, sql, params, duration in pending:
+            key = normalize_sql(sql)
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = {
+                    'sql': sql,
+                    'normalized': key,
+                    'params': repr(params),
+                    'alias': alias,
+                    'count': 0,
+                    'total_ms': 0,
+                    'max_ms': 0,
+                    'plan': self.explain(alias, sql, params),
+                }
+            duration_ms = duration * 1000
+            entry['count'] += 1
+            entry['total_ms'] += duration_ms
+            entry['max_ms'] = max(entry['max_ms'], duration_ms)
+
+        report = sorted(self.entries.values(), key=lambda e: -e['total_ms'])
+        # Replaced in one step, so a reader never sees half a report.
+        temp_filename = '%s.%d.%d.tmp' % (self.filename, self.pid,
+            threading.current_thread().ident)
+        fh = open(temp_filename, 'w')
+        try:
+            json.dump(report, fh, indent=2, sort_keys=True)
+        finally:
+            fh.close()
+        os.rename(temp_filename, self.filename)
+
+
+def install_slow_query_log(threshold_ms, filename, analyze=False):
+    """Wraps every database cursor to capture slow queries. The report is
+    written after each request and when the process exits.
+    """
+    global _slow_queries
+    from django.core.signals import request_finished
+    from django.db.backends import BaseDatabaseWrapper
+
+    _slow_queries = SlowQueryLog(threshold_ms / 1000.0, filename, analyze)
+    original_cursor = getattr(BaseDatabaseWrapper.cursor, '_djangomini_original',
+        BaseDatabaseWrapper.cursor)
+
+    def cursor(self):
+        return SlowQueryCursor(original_cursor(self), self.alias, _slow_queries)
+    cursor._djangomini_original = original_cursor
+
+    BaseDatabaseWrapper.cursor = cursor
+    request_finished.connect(flush_slow_queries, dispatch_uid='djangomini.slow_queries')
+    atexit.register(flush_slow_queries)
+
+    return _slow_queries
+
+
+def flush_slow_queries(**kwargs):
+    if _slow_queries is not None:
+        _slow_queries.flush()
+
+
+def task(func=None, retries=0, retry_delay=1.0):
+    """Decorator that makes a function a background task. Call its delay()
+    method with the function's arguments to save the task to the database,
+    for a worker to run later. The arguments must be JSON serializable.
+
+    A task that raises an exception is tried again up to retries times,
+    waiting retry_delay seconds, doubling each time.
+    """
+    def decorate(func):
+        name = '%s.%s' % (func.__module__, func.__name__)
+
+        def delay(*args, **kwargs):
+            return enqueue(name, args, kwargs, retries, retry_delay)
+
+        func.task_name = name
+        func.delay = delay
+        _tasks[name] = func
+        return func
+
+    if func is None:
+        return decorate
+    return decorate(func)
+
+
+def _now():
+    try:
+        from django.utils.timezone import now
+    except ImportError:
+        # Django 1.3
+        import datetime
+        now = datetime.datetime.now
+    return now()
+
+
+def get_task_model():
+    """Returns the model for saved tasks. It is made on first use because
+    models can only be defined once settings are configured.
+    """
+    global _task_model
+    from django.db import models
+
+    if _task_model is None:
+        class Task(models.Model):
+            name = models.CharField(max_length=200)
+            arguments = models.TextField()
+            status = models.CharField(max_length=10, default='pending', db_index=True)
+            attempts = models.IntegerField(default=0)
+            retries = models.IntegerField(default=0)
+            retry_delay = models.FloatField(default=1.0)
+            run_after = models.DateTimeField(db_index=True)
+            claimed_at = models.DateTimeField(null=True)
+            error = models.TextField(blank=True)
+
+            class Meta:
+                app_label = 'djangomini'
+                db_table = 'djangomini_task'
+
+        _task_model = Task
+
+    return _task_model
+
+
+def create_task_table():
+    """Creates the table for saved tasks if it doesn't exist."""
+    global _task_table_exists
+    from django.core.management.color import no_style
+    from django.db import connection, transaction
+
+    Task = get_task_model()
+    _task_table_lock.acquire()
+    try:
+        if Task._meta.db_table in connection.introspection.table_names():
+            _task_table_exists = True
+            return
+
+        style = no_style()
+        statements, references = connection.creation.sql_create_model(Task, style)
+        statements += connection.creation.sql_indexes_for_model(Task, style)
+        cursor = connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        transaction.commit_unless_managed()
+        _task_table_exists = True
+    finally:
+        _task_table_lock.release()
+
+
+def enqueue(name, args=(), kwargs=None, retries=0, retry_delay=1.0):
+    """Saves a task to be run by a worker. Returns the saved task."""
+    import json
+
+    if not _task_table_exists:
+        create_task_table()
+    arguments = json.dumps([list(args), kwargs or {}])
+    return get_task_model().objects.create(name=name, arguments=arguments,
+        retries=retries, retry_delay=retry_delay, run_after=_now())
+
+
+def find_task(name):
+    """Returns the task function for a name, importing its module if the
+    task hasn't been registered yet.
+    """
+    if name not in _tasks:
+        module, sep, attr = name.rpartition('.')
+        __import__(module)
+    return _tasks[name]
+
+
+def claim_tasks(batch_size, lease=300):
+    """Marks up to batch_size waiting tasks as running and returns them.
+    A task is only claimed by one worker, even in other processes.
+
+    A task still running lease seconds after it was claimed is assumed to
+    have lost its worker, and is claimed again.
+    """
+    import datetime
+    from django.db.models import Q
+
+    Task = get_task_model()
+    now = _now()
+    expired = now - datetime.timedelta(seconds=lease)
+    waiting = Task.objects.filter(Q(status='pending', run_after__lte=now)
+        | Q(status='running', claimed_at__lt=expired))
+    rows = list(waiting.order_by('run_after', 'id')
+        .values_list('id', 'status', 'claimed_at')[:batch_size])
+
+    claimed = []
+    for pk, status, claimed_at in rows:
+        # Only one worker's update finds the row as it was read.
+        if Task.objects.filter(pk=pk, status=status, claimed_at=claimed_at).update(
+                status='running', claimed_at=now):
+            claimed.append(pk)
+
+    return list(Task.objects.filter(pk__in=claimed).order_by('run_after', 'id'))
+
+
+def run_task(saved_task):
+    """Runs a claimed task. A task that succeeds is deleted. One that fails
+    is retried later or, when it has no retries left, marked 'failed'.
+    Returns True if the task succeeded.
+    """
+    import datetime
+    import json
+    import traceback
+
+    try:
+        func = find_task(saved_task.name)
+        args, kwargs = json.loads(saved_task.arguments)
+        # Keyword names must be str for Python 2.
+        func(*args, **dict((str(k), v) for k, v in kwargs.items()))
+    except Exception:
+        logging.exception('Task %s (%d) failed', saved_task.name, saved_task.pk)
+        saved_task.attempts += 1
+        saved_task.error = traceback.format_exc()
+        if saved_task.attempts <= saved_task.retries:
+            delay = saved_task.retry_delay * 2 ** (saved_task.attempts - 1)
+            saved_task.status = 'pending'
+            saved_task.run_after = _now() + datetime.timedelta(seconds=delay)
+        else:
+            saved_task.status = 'failed'
+        saved_task.save()
+        return False
+
+    saved_task.delete()
+    return True
+
+
+class TaskWorker(threading.Thread):
+    """A thread that runs saved tasks, batch_size at a time."""
+    def __init__(self, batch_size=10, poll_interval=1.0, burst=False, lease=300):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.burst = burst
+        self.lease = lease
+        self.stopping = threading.Event()
+
+    def run(self):
+        from django.db import connection, transaction
+
+        try:
+            while not self.stopping.is_set():
+                failed = False
+                try:
+                    saved_tasks = claim_tasks(self.batch_size, self.lease)
+                except Exception:
+                    logging.exception('Failed to fetch tasks')
+                    saved_tasks = []
+                    failed = True
+                for saved_task in saved_tasks:
+                    try:
+                        run_task(saved_task)
+                    except Exception:
+                        logging.exception('Failed to save task %s (%d)',
+                            saved_task.name, saved_task.pk)
+                        failed = True
+                # Reads aren't committed, so the transaction they started
+                # would stay open, and MySQL would keep showing the same
+                # snapshot without any new tasks.
+                if failed:
+                    transaction.rollback_unless_managed()
+                else:
+                    transaction.commit_unless_managed()
+                if not saved_tasks:
+                    if self.burst:
+                        break
+                    self.stopping.wait(self.poll_interval)
+        finally:
+            # Each thread has its own database connection.
+            connection.close()
+
+    def stop(self):
+        self.stopping.set()
+
+
+def start_task_workers(count, batch_size=10, poll_interval=1.0, burst=False, lease=300):
+    """Starts count TaskWorker threads and returns them."""
+    workers = []
+    for i in range(count):
+        worker = TaskWorker(batch_size, poll_interval, burst, lease)
+        worker.start()
+        workers.append(worker)
+
+    return workers
+
+
+def app_directories(names):
+    """Returns the directory of each named app package."""
+    dirs = []
+    for name in names:
+        __import__(name)
+        path = os.path.dirname(os.path.abspath(sys.modules[name].__file__))
+        if path not in dirs:
+            dirs.append(path)
+
+    return dirs
+
+
+_ignored_suffixes = ('.pyc', '.pyo', '~', '.swp', '.swx', '.tmp')
+
+
+def _watched_file(filename):
+    """Returns False for compiled and editor temporary files."""
+    return not filename.endswith(_ignored_suffixes) and not filename.startswith('.')
+
+
+class PollingWatcher(object):
+    """Watches the files under a list of directories by checking their
+    modification times.
+    """
+    def __init__(self, dirs, interval=1.0):
+        self.dirs = dirs
+        self.interval = interval
+        self.mtimes = self.snapshot()
+
+    def snapshot(self):
+        mtimes = {}
+        for top in self.dirs:
+            for dirpath, dirnames, filenames in os.walk(top):
+                for filename in filenames:
+                    if _watched_file(filename):
+                        path = os.path.join(dirpath, filename)
+                        try:
+                            mtimes[path] = os.stat(path).st_mtime
+                        except OSError:
+                            pass
+        return mtimes
+
+    def wait(self, timeout):
+        """Returns True if any file changed within timeout seconds."""
+        time.sleep(min(timeout, self.interval))
+        mtimes = self.snapshot()
+        changed = mtimes != self.mtimes
+        self.mtimes = mtimes
+
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Watches the files under a list of directories using Linux's inotify
+    API via ctypes. Raises OSError if inotify is not available.
+    """
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    mask = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+        | IN_CREATE | IN_DELETE)
+    event_header = struct.Struct('iIII')
+
+    def __init__(self, dirs):
+        import ctypes
+        import ctypes.util
+
+        libname = ctypes.util.find_library('c')
+        if not libname or not sys.platform.startswith('linux'):
+            raise OSError('inotify is not available')
+        self.libc = ctypes.CDLL(libname, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init'):
+            raise OSError('inotify is not available')
+
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+
+        for top in dirs:
+            for dirpath, dirnames, filenames in os.walk(top):
+                path = dirpath.encode(sys.getfilesystemencoding())
+                if self.libc.inotify_add_watch(self.fd, path, self.mask) < 0:
+                    self.close()
+                    raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+    def wait(self, timeout):
+        """Returns True if any file changed within timeout seconds."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        changed = False
+        while offset < len(data):
+            wd, mask, cookie, length = self.event_header.unpack_from(data, offset)
+            offset += self.event_header.size
+            name = data[offset:offset + length].rstrip('\0'.encode('ascii'))
+            offset += length
+            if _watched_file(name.decode(sys.getfilesystemencoding())):
+                changed = True
+
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher(dirs):
+    """Returns an inotify watcher for the directories, or a polling watcher
+    if inotify is not available.
+    """
+    try:
+        return InotifyWatcher(dirs)
+    except OSError:
+        return PollingWatcher(dirs)
+
+
+def wait_for_changes(watcher, timeout=1.0, debounce=0.25):
+    """Returns True when a file has changed and no further changes have been
+    seen for debounce seconds, so a burst of saves causes a single reload.
+    Returns False if nothing changed within timeout seconds.
+    """
+    if not watcher.wait(timeout):
+        return False
+
+    while watcher.wait(debounce):
+        pass
+
+    return True
+
+
+def install_app_reloader(names):
+    """Replaces the runserver autoreloader so that it restarts the server
+    only when files in the named app packages change.
+    """
+    from django.utils import autoreload
+
+    dirs = app_directories(names)
+
+    def reloader_thread():
+        watcher = make_watcher(dirs)
+        try:
+            while autoreload.RUN_RELOADER:
+                if wait_for_changes(watcher):
+                    sys.exit(3) # Tells the parent process to restart us.
+        finally:
+            watcher.close()
+
+    autoreload.reloader_thread = reloader_thread
+
+
 if __name__ == "__main__":
     main(sys.argv)
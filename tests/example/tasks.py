@@ -0,0 +1,7 @@
+import djangomini
+from .models import Flavour
+
+
+@djangomini.task(retries=1)
+def add_flavour(name):
+    Flavour.objects.create(name=name)
@@ -1,3 +1,4 @@
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 
@@ -17,3 +18,106 @@ class ExampleTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn('object_list', response.context)
         self.assertEqual(response.context['object_list'].count(), 3)
+
+    def test_seed(self):
+        # The seed command fills the model, respecting the unique name.
+        from example.models import Flavour
+
+        call_command('seed', 'example', rows=50, batch_size=20)
+        self.assertEqual(Flavour.objects.count(), 50)
+        self.assertEqual(Flavour.objects.values('name').distinct().count(), 50)
+
+        call_command('seed', 'example', rows=10)
+        self.assertEqual(Flavour.objects.count(), 60)
+
+    def test_explain_slow(self):
+        # Slow queries made by a request are saved with their plan.
+        import djangomini
+        import json, os, tempfile
+        from django.core.signals import request_finished
+        from django.db.backends import BaseDatabaseWrapper
+
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        original_cursor = BaseDatabaseWrapper.cursor
+        try:
+            djangomini.install_slow_query_log(0, filename)
+            self.client.get(reverse('flavour_list'))
+            report = json.load(open(filename))
+        finally:
+            BaseDatabaseWrapper.cursor = original_cursor
+            request_finished.disconnect(dispatch_uid='djangomini.slow_queries')
+            djangomini._slow_queries = None
+            os.remove(filename)
+
+        selects = [entry for entry in report if 'example_flavour' in entry['sql']]
+        self.assertTrue(selects)
+        self.assertTrue(selects[0]['plan'])
+
+    def test_help(self):
+        # django-mini's own commands are listed with Django's.
+        from django.core.management import ManagementUtility
+
+        text = ManagementUtility(['django-mini', 'help']).main_help_text()
+        self.assertTrue('seed' in text)
+        self.assertTrue('worker' in text)
+
+    def test_tasks(self):
+        # A delayed task is saved, then claimed and run by a worker.
+        import djangomini
+        from example.models import Flavour
+        from example.tasks import add_flavour
+
+        add_flavour.delay('mint')
+        self.assertFalse(Flavour.objects.filter(name='mint').exists())
+
+        saved_tasks = djangomini.claim_tasks(10)
+        self.assertEqual(len(saved_tasks), 1)
+        self.assertEqual(djangomini.claim_tasks(10), [])
+        # A task claimed longer ago than the lease is claimed again.
+        self.assertEqual(djangomini.claim_tasks(10, lease=-1), saved_tasks)
+
+        self.assertTrue(djangomini.run_task(saved_tasks[0]))
+        self.assertTrue(Flavour.objects.filter(name='mint').exists())
+        self.assertEqual(djangomini.get_task_model().objects.count(), 0)
+
+    def test_export_rows(self):
+        # Rows are read a chunk at a time, in primary key order.
+        import djangomini
+        from example.models import Flavour
+
+        names = ['flavour%02d' % i for i in range(25)]
+        for name in names:
+            Flavour.objects.create(name=name)
+
+        rows = djangomini.iter_rows(Flavour.objects.all(), ['name'], chunk_size=10)
+        self.assertEqual([row[0] for row in rows], names)
+
+        after = Flavour.objects.get(name='flavour19').pk
+        rows = djangomini.iter_rows(Flavour.objects.all(), ['name'], after, chunk_size=10)
+        self.assertEqual([row[0] for row in rows], names[20:])
+
+    def test_export_view(self):
+        # The export view streams a model as JSON.
+        import djangomini
+        import json
+        from django.test.client import RequestFactory
+        from example.models import Flavour
+
+        Flavour.objects.create(name='vanilla')
+        request = RequestFactory().get('/export/example/flavour.json')
+        response = djangomini.export_view(request, 'example', 'flavour', 'json')
+
+        self.assertTrue(djangomini.is_streaming(response))
+        content = ''.join(chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk
+            for chunk in response)
+        self.assertEqual([row['name'] for row in json.loads(content)], ['vanilla'])
+
+    def test_export_view_bad_after(self):
+        # An 'after' value that isn't a primary key is a bad request.
+        import djangomini
+        from django.test.client import RequestFactory
+
+        request = RequestFactory().get('/export/example/flavour.json', {'after': 'abc'})
+        response = djangomini.export_view(request, 'example', 'flavour', 'json')
+        self.assertEqual(response.status_code, 400)
@@ -4,6 +4,7 @@ from mock import MagicMock, Mock, patch, call
 from optparse import OptionParser
 import django
 import djangomini
+import logging
 import unittest
 
 
@@ -15,13 +16,15 @@ class BaseTest(unittest.TestCase):
     def setUp(self):
         import django.conf
 
-        self._original_settings = django.conf.settings
-        django.conf.settings = django.conf.LazySettings()
+        # Reset the settings object in place, because modules that have
+        # imported it keep a reference to it.
+        self._original_settings = django.conf.settings._wrapped
+        django.conf.settings._wrapped = django.conf.LazySettings()._wrapped
 
     def tearDown(self):
         import django.conf
 
-        django.conf.settings = self._original_settings
+        django.conf.settings._wrapped = self._original_settings
 
 
 class AddAppNameTests(BaseTest):
@@ -52,6 +55,23 @@ class ParsingArgumentsTests(BaseTest):
             'apps': [],
             'database': 'sqlite:///:memory:',
             'debug_toolbar': False,
+            'metrics': False,
+            'log_file': None,
+            'log_queue_size': 10000,
+            'access_log': False,
+            'explain_slow': None,
+            'explain_file': 'slow-queries.json',
+            'explain_analyze': False,
+            'workers': 0,
+            'bind': '127.0.0.1:8000',
+            'warmup': [],
+            'coalesce': [],
+            'concurrency': {},
+            'export': [],
+            'task_workers': 0,
+            'watch_apps': False,
+            'batch': None,
+            'batch_continue': False,
         }
 
         for option, value in expected.items():
@@ -274,6 +294,1016 @@ class MainTests(BaseTest):
         self.assertEqual(settings.STATIC_URL, '/cdn/')
 
 
+class BatchTests(BaseTest):
+    def test_read_batch(self):
+        # Each non-blank line is split like a shell command line.
+        lines = [
+            '# Set up the database.\n',
+            'syncdb --noinput\n',
+            '\n',
+            'loaddata "my fixture.json"  # Initial data.\n',
+        ]
+        result = djangomini.read_batch(lines)
+        self.assertEqual(result, [['syncdb', '--noinput'], ['loaddata', 'my fixture.json']])
+
+    @patch('djangomini.run_batch_command')
+    def test_run_batch(self, run_batch_command):
+        # run_batch() runs each command in order and counts failures.
+        commands = [['syncdb'], ['validate']]
+        result = djangomini.run_batch(commands)
+
+        self.assertEqual(result, 0)
+        self.assertEqual(run_batch_command.call_args_list, [call(['syncdb']), call(['validate'])])
+
+    @patch('sys.stderr')
+    @patch('djangomini.run_batch_command')
+    def test_run_batch_stops_on_error(self, run_batch_command, stderr):
+        # run_batch() stops at the first failure unless told to continue.
+        run_batch_command.side_effect = ValueError('bad')
+        commands = [['syncdb'], ['validate']]
+
+        self.assertEqual(djangomini.run_batch(commands), 1)
+        self.assertEqual(run_batch_command.call_count, 1)
+
+        run_batch_command.reset_mock()
+        self.assertEqual(djangomini.run_batch(commands, stop_on_error=False), 2)
+        self.assertEqual(run_batch_command.call_count, 2)
+
+    @patch('sys.stderr')
+    @patch('djangomini.run_batch_command')
+    def test_run_batch_system_exit(self, run_batch_command, stderr):
+        # A command calling sys.exit() is a failure, not the end of the batch.
+        run_batch_command.side_effect = [SystemExit(1), None]
+        commands = [['test'], ['validate']]
+
+        self.assertEqual(djangomini.run_batch(commands, stop_on_error=False), 1)
+        self.assertEqual(run_batch_command.call_count, 2)
+        self.assertTrue('exit status 1' in stderr.write.call_args_list[0][0][0])
+
+    @patch('sys.stderr')
+    @patch('djangomini.run_batch_command')
+    def test_run_batch_exit_status(self, run_batch_command, stderr):
+        # Exiting with status 0 succeeds, and the autoreloader's restart
+        # status 3 ends the batch.
+        run_batch_command.side_effect = [SystemExit(0), SystemExit(None), SystemExit(3)]
+        commands = [['validate', '--help'], ['validate'], ['runserver']]
+
+        self.assertRaises(SystemExit, djangomini.run_batch, commands)
+        self.assertEqual(run_batch_command.call_count, 3)
+        run_batch_command.side_effect = SystemExit(0)
+        self.assertEqual(djangomini.run_batch(commands[:1]), 0)
+
+    @patch(url_import_patch)
+    @patch('sys.stderr')
+    @patch('djangomini.run_batch')
+    def test_main_batch_runserver(self, run_batch, stderr, import_module):
+        # runserver in a batch must not use the autoreloader.
+        with patch('sys.stdin', ['syncdb --noinput\n', 'runserver\n']):
+            self.assertRaises(SystemExit, djangomini.main, 'django-mini --batch -'.split())
+        self.assertFalse(run_batch.called)
+
+    @patch('sys.stderr')
+    def test_main_batch_with_command(self, stderr):
+        # --batch can't be combined with a command.
+        argv = 'django-mini --batch commands.txt runserver'.split()
+        self.assertRaises(SystemExit, djangomini.main, argv)
+
+    @patch(url_import_patch)
+    @patch('djangomini.run_batch')
+    @patch('django.core.management.execute_from_command_line')
+    def test_main_batch(self, execute_from_command_line, run_batch, import_module):
+        # main() with --batch runs the listed commands instead of argv.
+        run_batch.return_value = 0
+        with patch('sys.stdin', ['syncdb --noinput\n', 'validate\n']):
+            djangomini.main('django-mini --batch - -a app1'.split())
+
+        self.assertFalse(execute_from_command_line.called)
+        run_batch.assert_called_once_with([['syncdb', '--noinput'], ['validate']],
+            stop_on_error=True)
+
+
+class ReloaderTests(BaseTest):
+    def test_watched_file(self):
+        # Compiled and temporary files don't trigger a reload.
+        self.assertTrue(djangomini._watched_file('models.py'))
+        self.assertTrue(djangomini._watched_file('list.html'))
+        self.assertFalse(djangomini._watched_file('models.pyc'))
+        self.assertFalse(djangomini._watched_file('.models.py.swp'))
+        self.assertFalse(djangomini._watched_file('models.py~'))
+
+    def test_wait_for_changes(self):
+        # A burst of changes is reported once, after it has finished.
+        watcher = Mock()
+        watcher.wait.side_effect = [True, True, True, False]
+        self.assertTrue(djangomini.wait_for_changes(watcher))
+        self.assertEqual(watcher.wait.call_count, 4)
+
+    def test_wait_for_no_changes(self):
+        watcher = Mock()
+        watcher.wait.return_value = False
+        self.assertFalse(djangomini.wait_for_changes(watcher))
+
+    def test_polling_watcher(self):
+        # The polling watcher notices a new file in a watched directory.
+        import os, shutil, tempfile
+
+        path = tempfile.mkdtemp()
+        try:
+            watcher = djangomini.PollingWatcher([path], interval=0)
+            self.assertFalse(watcher.wait(0))
+            open(os.path.join(path, 'models.py'), 'w').close()
+            self.assertTrue(watcher.wait(0))
+        finally:
+            shutil.rmtree(path)
+
+    @patch('djangomini.app_directories')
+    def test_install_app_reloader(self, app_directories):
+        # Django's reloader thread is replaced with our own.
+        from django.utils import autoreload
+
+        original = autoreload.reloader_thread
+        try:
+            djangomini.install_app_reloader(['example'])
+            self.assertNotEqual(autoreload.reloader_thread, original)
+        finally:
+            autoreload.reloader_thread = original
+
+
+class MetricsTests(BaseTest):
+    def test_find_mount(self):
+        # Requests are labelled by the app mount with the longest prefix.
+        mounts = [('app1', ''), ('app2', 'foo'), ('app3', 'foo/bar')]
+        tests = [
+            ('/', ('app1', '')),
+            ('/foo/', ('app2', 'foo')),
+            ('/foobar/', ('app1', '')),
+            ('/foo/bar/baz/', ('app3', 'foo/bar')),
+        ]
+
+        for path, expected in tests:
+            self.assertEqual(djangomini.find_mount(path, mounts), expected)
+
+        self.assertEqual(djangomini.find_mount('/foo/', []), ('', ''))
+
+    def test_render(self):
+        # Values are rendered in Prometheus text format.
+        registry = djangomini.MetricsRegistry()
+        labels = {'app': 'app1', 'prefix': ''}
+        registry.inc('djangomini_requests_total', labels, 2)
+        registry.observe('djangomini_db_queries', labels, 3)
+        result = registry.render().splitlines()
+
+        self.assertTrue('# TYPE djangomini_requests_total counter' in result)
+        self.assertTrue('djangomini_requests_total{app="app1",prefix=""} 2' in result)
+        self.assertTrue('# TYPE djangomini_db_queries histogram' in result)
+        self.assertTrue('djangomini_db_queries_bucket{app="app1",prefix="",le="2"} 0' in result)
+        self.assertTrue('djangomini_db_queries_bucket{app="app1",prefix="",le="5"} 1' in result)
+        self.assertTrue('djangomini_db_queries_sum{app="app1",prefix=""} 3' in result)
+
+    def test_collect_processes(self):
+        # Values written by other processes are added to our own.
+        import os, shutil, tempfile
+
+        path = tempfile.mkdtemp()
+        try:
+            registry = djangomini.MetricsRegistry(path)
+            registry.inc('djangomini_requests_total', {'app': 'app1'})
+            registry.flush(force=True)
+            os.rename(registry.filename(), registry.filename(pid=1))
+            registry.inc('djangomini_requests_total', {'app': 'app1'})
+
+            key = ('djangomini_requests_total', (('app', 'app1'),))
+            with patch('djangomini._process_exists', return_value=True):
+                self.assertEqual(registry.collect()[key], 3)
+        finally:
+            shutil.rmtree(path)
+
+    def test_collect_dead_processes(self):
+        # Files left by processes that have gone are ignored.
+        import os, shutil, tempfile
+
+        path = tempfile.mkdtemp()
+        try:
+            registry = djangomini.MetricsRegistry(path)
+            registry.inc('djangomini_requests_total', {'app': 'app1'})
+            registry.flush(force=True)
+            os.rename(registry.filename(), registry.filename(pid=1))
+            registry.inc('djangomini_requests_total', {'app': 'app1'})
+
+            key = ('djangomini_requests_total', (('app', 'app1'),))
+            with patch('djangomini._process_exists', return_value=False):
+                self.assertEqual(registry.collect()[key], 2)
+
+            registry.flush(force=True)
+            registry.remove_file()
+            self.assertFalse(os.path.exists(registry.filename()))
+        finally:
+            shutil.rmtree(path)
+
+    @patch(url_import_patch)
+    @patch('django.core.management.execute_from_command_line')
+    def test_main_metrics(self, execute_from_command_line, import_module):
+        # main() with --metrics adds the middleware and the app mounts.
+        from django.conf import settings
+        djangomini.main('django-mini --metrics -a app1:foo runserver'.split())
+
+        self.assertTrue('djangomini.MetricsMiddleware' in settings.MIDDLEWARE_CLASSES)
+        self.assertEqual(settings.APP_MOUNTS, [('app1', 'foo')])
+
+
+class PreforkTests(BaseTest):
+    @patch('sys.stderr')
+    def test_warm_up(self, stderr):
+        # Each warm-up URL is requested from the WSGI application.
+        application = Mock(return_value=['content'])
+        djangomini.warm_up(application, ['/foo/', '/bar/?page=2'])
+
+        environs = [args[0][0] for args in application.call_args_list]
+        self.assertEqual([e['PATH_INFO'] for e in environs], ['/foo/', '/bar/'])
+        self.assertEqual([e['QUERY_STRING'] for e in environs], ['', 'page=2'])
+
+    def test_metrics_reset(self):
+        # Values recorded before forking are forgotten, file and all.
+        import os, shutil, tempfile
+
+        path = tempfile.mkdtemp()
+        try:
+            registry = djangomini.MetricsRegistry(path)
+            registry.inc('djangomini_requests_total', {'app': 'app1'})
+            registry.flush(force=True)
+            registry.reset()
+
+            self.assertEqual(registry.collect(), {})
+            self.assertFalse(os.path.exists(registry.filename()))
+        finally:
+            shutil.rmtree(path)
+
+    def test_format_memory_usage(self):
+        usage = {'rss': 2048, 'private': 512, 'shared_clean': 1536}
+        result = djangomini.format_memory_usage(usage)
+        self.assertEqual(result, 'rss=2048kB private=512kB')
+
+    def test_memory_usage(self):
+        usage = djangomini.memory_usage()
+        self.assertTrue(usage.get('rss', usage.get('peak_rss')) > 0)
+
+    @patch('djangomini._read_kb_values')
+    def test_memory_usage_fallbacks(self, read_kb_values):
+        # Without smaps_rollup the current RSS comes from /proc/self/status,
+        # and without /proc the peak RSS is reported as such, in kilobytes.
+        import resource
+
+        read_kb_values.side_effect = lambda filename: (
+            {'vmrss': 1234} if filename.endswith('status') else {})
+        self.assertEqual(djangomini.memory_usage(), {'rss': 1234})
+
+        read_kb_values.side_effect = lambda filename: {}
+        with patch('resource.getrusage') as getrusage:
+            getrusage.return_value.ru_maxrss = 2048 * 1024
+            with patch('sys.platform', 'darwin'):
+                self.assertEqual(djangomini.memory_usage(), {'peak_rss': 2048})
+            with patch('sys.platform', 'freebsd9'):
+                self.assertEqual(djangomini.memory_usage(), {'peak_rss': 2048 * 1024})
+
+    @patch(url_import_patch)
+    @patch('djangomini.serve_prefork')
+    @patch('django.core.management.execute_from_command_line')
+    def test_main_workers(self, execute_from_command_line, serve_prefork, import_module):
+        # main() with --workers serves the site instead of running a command.
+        argv = 'django-mini -a app1 --workers 4 --bind :8080 --warmup /foo/'.split()
+        djangomini.main(argv)
+
+        self.assertFalse(execute_from_command_line.called)
+        serve_prefork.assert_called_once_with('127.0.0.1', 8080, 4, ['/foo/'])
+
+
+class LoggingTests(BaseTest):
+    def make_record(self, msg, *args):
+        return logging.LogRecord('test', logging.INFO, __file__, 1, msg, args, None)
+
+    def test_queue_handler_drops(self):
+        # Records are dropped and counted when the queue is full.
+        handler = djangomini.QueueHandler(djangomini.Queue(2))
+        for i in range(5):
+            handler.emit(self.make_record('message %d', i))
+
+        self.assertEqual(handler.queue.qsize(), 2)
+        self.assertEqual(handler.dropped, 3)
+        self.assertEqual(handler.queue.get().msg, 'message 0')
+
+    @patch('sys.stderr')
+    def test_queue_handler_bad_format(self, stderr):
+        # A bad format string is reported, not raised to the caller.
+        handler = djangomini.QueueHandler(djangomini.Queue())
+        handler.emit(self.make_record('%d', 'x'))
+        self.assertEqual(handler.queue.qsize(), 0)
+
+    def test_log_file_closed(self):
+        # Configuring logging again closes the earlier log file.
+        import os, tempfile
+
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        root = logging.getLogger()
+        handlers, level = list(root.handlers), root.level
+        try:
+            djangomini.configure_logging(filename)
+            stream = djangomini._log_writer.stream
+            djangomini.configure_logging(filename)
+            self.assertTrue(stream.closed)
+        finally:
+            djangomini.stop_log_writer()
+            root.handlers[:] = handlers
+            root.setLevel(level)
+            os.remove(filename)
+
+    def test_log_writer(self):
+        # The writer thread writes the queued records until it is stopped.
+        stream = Mock()
+        queue = djangomini.Queue()
+        writer = djangomini.LogWriter(queue, stream, logging.Formatter('%(message)s'))
+        queue.put(self.make_record('one'))
+        queue.put(self.make_record('two'))
+        writer.start()
+        writer.stop()
+
+        written = ''.join(args[0][0] for args in stream.write.call_args_list)
+        self.assertEqual(written, 'one\ntwo\n')
+        self.assertFalse(writer.is_alive())
+
+    @patch('djangomini.access_logger')
+    def test_access_log_middleware(self, access_logger):
+        # Each response is logged as a JSON object.
+        import json
+
+        request = Mock(method='GET', path='/foo/', META={'REMOTE_ADDR': '127.0.0.1'})
+        response = Mock(status_code=200, content='hello', streaming=False)
+        response.get.return_value = None
+
+        middleware = djangomini.AccessLogMiddleware()
+        middleware.process_request(request)
+        self.assertTrue(middleware.process_response(request, response) is response)
+
+        entry = json.loads(access_logger.info.call_args[0][0])
+        self.assertEqual(entry['path'], '/foo/')
+        self.assertEqual(entry['status'], 200)
+        self.assertEqual(entry['size'], 5)
+
+
+class SeedTests(BaseTest):
+    def make_field(self, kind, **attrs):
+        defaults = {'rel': None, 'choices': [], 'unique': False, 'null': False,
+            'max_length': 200}
+        defaults.update(attrs)
+        field = Mock(**defaults)
+        field.get_internal_type.return_value = kind
+        return field
+
+    def make_random(self, seed=0):
+        model = Mock()
+        model._meta.db_table = 'example_flavour'
+        return djangomini._batch_random(seed, model, 0)
+
+    def test_batch_random(self):
+        # The same seed gives the same data.
+        self.assertEqual(self.make_random().random(), self.make_random().random())
+        self.assertNotEqual(self.make_random().random(), self.make_random(1).random())
+
+    def test_unique_char_field(self):
+        # Unique values end with the row number and fit the field.
+        field = self.make_field('CharField', unique=True, max_length=10)
+        value = djangomini.fake_value(field, self.make_random(), 1234)
+        self.assertTrue(value.endswith('-1234'))
+        self.assertTrue(len(value) <= 10)
+
+    def test_unique_date_field(self):
+        # Unique dates are a day apart.
+        field = self.make_field('DateField', unique=True)
+        rng = self.make_random()
+        values = [djangomini.fake_value(field, rng, i) for i in range(3)]
+        self.assertEqual(len(set(values)), 3)
+
+    def test_unique_integer_field_range(self):
+        # Too many rows for a unique small integer is an error, not an overflow.
+        field = self.make_field('PositiveSmallIntegerField', unique=True)
+        self.assertEqual(djangomini.fake_value(field, self.make_random(), 32767), 32767)
+        self.assertRaises(ValueError, djangomini.fake_value, field, self.make_random(), 32768)
+
+    def test_unique_together(self):
+        # One field of each unique_together group gets unique values, or the
+        # combination of foreign keys is different for every row.
+        target = Mock()
+        fields = [self.make_field('ForeignKey', rel=Mock(to=target)),
+            self.make_field('ForeignKey', rel=Mock(to=target)),
+            self.make_field('IntegerField'), self.make_field('IntegerField')]
+        for field, name in zip(fields, ['a', 'b', 'c', 'd']):
+            field.name = name
+            field.attname = name
+        model = Mock(side_effect=lambda **values: values)
+        model._meta.fields = fields
+        model._meta.unique_together = [('a', 'b'), ('a', 'c')]
+
+        objects = djangomini.make_objects(model, 0, 4, self.make_random(), {target: [1, 2]})
+        self.assertEqual(len(set((o['a'], o['b']) for o in objects)), 4)
+        self.assertEqual([o['c'] for o in objects], [0, 1, 2, 3])
+        self.assertRaises(ValueError, djangomini.make_objects, model, 0, 5,
+            self.make_random(), {target: [1, 2]})
+
+    def test_choices(self):
+        field = self.make_field('CharField', choices=[('a', 'A'), ('b', 'B')],
+            flatchoices=[('a', 'A'), ('b', 'B')])
+        self.assertTrue(djangomini.fake_value(field, self.make_random(), 0) in ('a', 'b'))
+
+    def test_foreign_key(self):
+        # Foreign keys use the primary keys of the related model.
+        target = Mock()
+        field = self.make_field('ForeignKey', rel=Mock(to=target))
+        value = djangomini.fake_value(field, self.make_random(), 0, {target: [3, 4]})
+        self.assertTrue(value in (3, 4))
+
+        self.assertRaises(ValueError, djangomini.fake_value, field, self.make_random(), 0, {})
+
+    def test_unknown_field(self):
+        field = self.make_field('CustomField')
+        field.has_default.return_value = False
+        self.assertRaises(ValueError, djangomini.fake_value, field, self.make_random(), 0)
+
+    def test_sort_models(self):
+        # Related models come first.
+        parent, child = Mock(), Mock()
+        parent._meta.fields = [self.make_field('AutoField')]
+        child._meta.fields = [self.make_field('ForeignKey', rel=Mock(to=parent))]
+
+        self.assertEqual(djangomini._sort_models([child, parent]), [parent, child])
+
+    @patch('djangomini.restart_log_writer')
+    @patch('djangomini.stop_log_writer')
+    @patch('djangomini._insert_batches')
+    @patch('os._exit')
+    @patch('os.fork')
+    def test_seed_child_exits(self, fork, exit, insert_batches, stop_log_writer,
+            restart_log_writer):
+        # A forked child logs with its own writer thread and always exits,
+        # even when interrupted.
+        class Exited(Exception):
+            pass
+
+        djangomini.configure_settings({})
+        fork.return_value = 0
+        exit.side_effect = Exited
+        insert_batches.side_effect = KeyboardInterrupt
+        model = Mock()
+        model._meta.fields = []
+        model._default_manager.count.return_value = 0
+
+        with patch('django.db.connections'):
+            self.assertRaises(Exited, djangomini.seed_models, [model], 10, processes=2)
+        self.assertTrue(restart_log_writer.called)
+        exit.assert_called_once_with(1)
+
+    @patch('django.core.management.get_commands')
+    def test_install_commands(self, get_commands):
+        get_commands.return_value = commands = {}
+        djangomini.install_commands()
+        self.assertEqual(commands['seed'], 'djangomini')
+
+        from django.core.management import load_command_class
+        command = load_command_class(commands['worker'], 'worker')
+        self.assertTrue(command.help.startswith('Runs background tasks'))
+
+
+class SlowQueryTests(BaseTest):
+    def test_normalize_sql(self):
+        # Queries that differ only in their values are the same.
+        tests = [
+            ('SELECT * FROM t WHERE id = %s', 'SELECT * FROM t WHERE id = ?'),
+            ("SELECT * FROM t WHERE name = 'it''s'", 'SELECT * FROM t WHERE name = ?'),
+            ('SELECT *\n  FROM t1 LIMIT 21', 'SELECT * FROM t1 LIMIT ?'),
+            ('SELECT * FROM t WHERE id IN (%s, %s, %s)', 'SELECT * FROM t WHERE id IN (...)'),
+        ]
+
+        for value, expected in tests:
+            self.assertEqual(djangomini.normalize_sql(value), expected)
+
+    def test_backend_name(self):
+        self.assertEqual(djangomini.backend_name('django.db.backends.sqlite3'), 'sqlite')
+        self.assertEqual(djangomini.backend_name('custom.backend'), 'custom.backend')
+
+    def test_cursor_records(self):
+        # The cursor wrapper passes queries on and records them.
+        cursor, log = Mock(), Mock()
+        wrapper = djangomini.SlowQueryCursor(cursor, 'default', log)
+        wrapper.execute('SELECT %s', [1])
+
+        cursor.execute.assert_called_once_with('SELECT %s', [1])
+        self.assertEqual(log.record.call_args[0][:3], ('default', 'SELECT %s', [1]))
+
+    @patch('djangomini.SlowQueryLog.explain')
+    def test_flush(self, explain):
+        # Slow queries are explained once for each normalized statement.
+        import json, os, tempfile
+
+        explain.return_value = [['SCAN TABLE t']]
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            log = djangomini.SlowQueryLog(0.1, filename)
+            log.record('default', 'SELECT * FROM t WHERE id = %s', [1], 0.2)
+            log.record('default', 'SELECT * FROM t WHERE id = %s', [2], 0.3)
+            log.record('default', 'SELECT * FROM u', [], 0.05)
+            log.flush()
+
+            report = json.load(open(filename))
+        finally:
+            os.remove(filename)
+
+        self.assertEqual(explain.call_count, 1)
+        self.assertEqual(len(report), 1)
+        self.assertEqual(report[0]['count'], 2)
+        self.assertEqual(report[0]['plan'], [['SCAN TABLE t']])
+        self.assertAlmostEqual(report[0]['max_ms'], 300)
+
+    @patch('djangomini.SlowQueryLog.explain')
+    def test_flush_threads(self, explain):
+        # Request threads can flush at the same time.
+        import json, os, shutil, sys, tempfile, threading
+
+        explain.return_value = None
+        directory = tempfile.mkdtemp()
+        log = djangomini.SlowQueryLog(0.1, os.path.join(directory, 'slow.json'))
+        errors = []
+
+        def flush():
+            try:
+                for i in range(50):
+                    log.record('default', 'SELECT * FROM t', [], 0.2)
+                    log.flush()
+            except Exception:
+                errors.append(sys.exc_info()[1])
+
+        threads = [threading.Thread(target=flush) for i in range(4)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            report = json.load(open(log.filename))
+            self.assertEqual(os.listdir(directory), ['slow.json'])
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(report[0]['count'], 200)
+
+    @patch('djangomini.SlowQueryLog.explain')
+    def test_flush_forked(self, explain):
+        # A forked process writes its own report, without the parent's queries.
+        import json, os, shutil, tempfile
+
+        explain.return_value = None
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, 'slow.json')
+        try:
+            log = djangomini.SlowQueryLog(0.1, filename)
+            log.record('default', 'SELECT * FROM t', [], 0.2)
+            log.flush()
+            log.record('default', 'SELECT * FROM u', [], 0.2)
+            with patch('os.getpid', return_value=log.pid + 1):
+                log.record('default', 'SELECT * FROM v', [], 0.2)
+                log.flush()
+
+            self.assertEqual(sorted(os.listdir(directory)),
+                ['slow.%d.json' % log.pid, 'slow.json'])
+            report = json.load(open(log.filename))
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual([e['sql'] for e in report], ['SELECT * FROM v'])
+
+
+class ProfileTests(BaseTest):
+    def setUp(self):
+        import tempfile
+        super(ProfileTests, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+        super(ProfileTests, self).tearDown()
+
+    def test_profile_filename(self):
+        # Profiles are only used if a directory is set, one per command line.
+        with patch.dict('os.environ', {'DJANGOMINI_PROFILE_DIR': ''}):
+            self.assertEqual(djangomini.profile_filename(['runserver']), None)
+
+        with patch.dict('os.environ', {'DJANGOMINI_PROFILE_DIR': self.directory}):
+            first = djangomini.profile_filename(['-a', 'app1', 'runserver'])
+            second = djangomini.profile_filename(['-a', 'app2', 'runserver'])
+
+        self.assertTrue(first.startswith(self.directory))
+        self.assertNotEqual(first, second)
+
+    def test_profile_filename_module_changed(self):
+        # Editing djangomini makes a new profile, even without a new version.
+        import os
+
+        with patch.dict('os.environ', {'DJANGOMINI_PROFILE_DIR': self.directory}):
+            first = djangomini.profile_filename(['runserver'])
+            stat = os.stat(djangomini.__file__)
+            with patch('os.stat') as mock_stat:
+                mock_stat.return_value = Mock(st_size=stat.st_size, st_mtime=stat.st_mtime + 1)
+                second = djangomini.profile_filename(['runserver'])
+
+        self.assertNotEqual(first, second)
+
+    def test_save_profile(self):
+        # A saved profile loads the same options, settings and arguments.
+        import os
+
+        filename = os.path.join(self.directory, 'test.profile')
+        options, django_options, arguments = djangomini.parse_args(
+            '--admin -a app1:foo --foo [1,(2,3)] runserver'.split())
+        settings = djangomini.make_settings(options, django_options)
+        djangomini.save_profile(filename, options, settings, arguments)
+
+        loaded_options, loaded_settings, loaded_arguments = djangomini.load_profile(filename)
+        self.assertEqual(loaded_options.apps, [('app1', 'foo')])
+        self.assertEqual(loaded_settings, settings)
+        self.assertEqual(loaded_arguments, ['runserver'])
+
+    def test_load_missing_profile(self):
+        import os
+        filename = os.path.join(self.directory, 'missing.profile')
+        self.assertEqual(djangomini.load_profile(filename), None)
+
+    @patch(url_import_patch)
+    @patch('django.core.management.execute_from_command_line')
+    def test_main_profile(self, execute_from_command_line, import_module):
+        # The second run with the same arguments doesn't parse them.
+        argv = 'django-mini -a app1 --static-url /cdn/ runserver'.split()
+        with patch.dict('os.environ', {'DJANGOMINI_PROFILE_DIR': self.directory}):
+            djangomini.main(argv)
+            # Fresh Django settings, keeping the profile directory.
+            BaseTest.tearDown(self)
+            BaseTest.setUp(self)
+            with patch('djangomini.parse_args') as parse_args:
+                djangomini.main(argv)
+                self.assertFalse(parse_args.called)
+
+        from django.conf import settings
+        self.assertEqual(settings.STATIC_URL, '/cdn/')
+        self.assertEqual(execute_from_command_line.call_count, 2)
+
+
+class CoalesceTests(BaseTest):
+    def setUp(self):
+        super(CoalesceTests, self).setUp()
+        djangomini.configure_settings({'APP_MOUNTS': [('app1', ''), ('app2', 'foo')],
+            'COALESCE_APPS': ['app1'], 'COALESCE_TIMEOUT': 0.1})
+        self.middleware = djangomini.CoalesceMiddleware()
+
+    def make_request(self, method='GET', path='/bar/', **meta):
+        from django.http import HttpRequest
+
+        request = HttpRequest()
+        request.method = method
+        request.path = path
+        request.META = meta
+        return request
+
+    def test_request_key(self):
+        # Requests differ by query string and the vary headers.
+        key = self.middleware.request_key
+        request = self.make_request(QUERY_STRING='page=2', HTTP_ACCEPT='text/html')
+
+        self.assertEqual(key(request), key(self.make_request(QUERY_STRING='page=2',
+            HTTP_ACCEPT='text/html', HTTP_USER_AGENT='test')))
+        self.assertNotEqual(key(request), key(self.make_request(QUERY_STRING='page=3',
+            HTTP_ACCEPT='text/html')))
+        self.assertNotEqual(key(request), key(self.make_request(QUERY_STRING='page=2',
+            HTTP_COOKIE='sessionid=1')))
+
+    def test_ignored_requests(self):
+        # Only safe requests for the named apps are coalesced.
+        for request in [self.make_request(method='POST'), self.make_request(path='/foo/')]:
+            self.assertEqual(self.middleware.process_request(request), None)
+            self.assertFalse(hasattr(request, '_coalesce_key'))
+
+    def test_shared_response(self):
+        # A request waiting for an identical request gets a copy of its response.
+        import threading
+        from django.http import HttpResponse
+
+        self.middleware.timeout = 5
+        leader = self.make_request()
+        self.assertEqual(self.middleware.process_request(leader), None)
+
+        # Only respond once the follower is waiting for the leader's flight.
+        flight = self.middleware.flights[leader._coalesce_key]
+        waiting = threading.Event()
+        original_wait = flight.event.wait
+
+        def wait(timeout=None):
+            waiting.set()
+            return original_wait(timeout)
+        flight.event.wait = wait
+
+        results = []
+        follower = threading.Thread(target=lambda:
+            results.append(self.middleware.process_request(self.make_request())))
+        follower.start()
+        waiting.wait(5)
+        response = HttpResponse('shared')
+        self.middleware.process_response(leader, response)
+        follower.join()
+
+        self.assertEqual(results[0].content, response.content)
+        self.assertFalse(results[0] is response)
+        self.assertEqual(self.middleware.flights, {})
+
+    def test_timeout(self):
+        # A waiting request makes its own response after the timeout.
+        self.middleware.process_request(self.make_request())
+        self.assertEqual(self.middleware.process_request(self.make_request()), None)
+
+
+class ConcurrencyLimitTests(BaseTest):
+    def test_parse_concurrency(self):
+        opts, django_opts, args = djangomini.parse_args(
+            '--concurrency app1:10 --concurrency myproject.app2:2 test'.split())
+        self.assertEqual(opts.concurrency, {'app1': 10, 'myproject.app2': 2})
+
+        for value in ['app1', 'app1:0', 'app1:x', ':2', 'app2:foo:2']:
+            self.assertRaises(SystemExit, djangomini.parse_args,
+                ['--concurrency', value, 'test'])
+
+    def test_limiter_rejects(self):
+        # Callers over the limit wait in the queue, then are rejected.
+        limiter = djangomini.ConcurrencyLimiter(1, 1, 0.01)
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire())
+
+        limiter.waiting = 1
+        self.assertFalse(limiter.acquire())
+
+        limiter.release(0.1)
+        self.assertTrue(limiter.acquire())
+
+    def test_limiter_adapts(self):
+        # The limit shrinks when latency rises, and grows back to the maximum.
+        limiter = djangomini.ConcurrencyLimiter(10, 10, 1)
+        for latency in [0.01, 0.01, 0.5, 0.5]:
+            limiter.acquire()
+            limiter.release(latency)
+        self.assertTrue(limiter.limit < 10)
+
+        for i in range(100):
+            limiter.acquire()
+            limiter.release(0.01)
+        self.assertEqual(limiter.limit, 10)
+
+    def test_middleware_rejects(self):
+        # Requests over the limit get a 503 response with Retry-After.
+        djangomini.configure_settings({'APP_MOUNTS': [('app1', 'foo'), ('app2', '')],
+            'CONCURRENCY_LIMITS': {'app1': 1}, 'CONCURRENCY_QUEUE_SIZE': 0})
+        middleware = djangomini.ConcurrencyLimitMiddleware()
+
+        first = Mock(path='/foo/')
+        self.assertEqual(middleware.process_request(first), None)
+        self.assertEqual(middleware.process_request(Mock(path='/bar/')), None)
+
+        response = middleware.process_request(Mock(path='/foo/'))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+
+        middleware.process_response(first, Mock())
+        self.assertEqual(middleware.process_request(Mock(path='/foo/')), None)
+
+    def test_middleware_request_finished(self):
+        # A request whose response never reached the middleware still gives
+        # back its place when the request finishes, and only once.
+        from django.core.signals import request_finished
+
+        djangomini.configure_settings({'APP_MOUNTS': [('app1', 'foo')],
+            'CONCURRENCY_LIMITS': {'app1': 1}, 'CONCURRENCY_QUEUE_SIZE': 0})
+        middleware = djangomini.ConcurrencyLimitMiddleware()
+        limiter = middleware.limiters['app1']
+
+        self.assertEqual(middleware.process_request(Mock(path='/foo/')), None)
+        request_finished.send(sender=None)
+        self.assertEqual(limiter.active, 0)
+
+        request = Mock(path='/foo/')
+        middleware.process_request(request)
+        middleware.process_response(request, Mock())
+        request_finished.send(sender=None)
+        self.assertEqual(limiter.active, 0)
+
+    def test_main_concurrency(self):
+        # The middleware comes before all others.
+        options, django_options, arguments = djangomini.parse_args(
+            '--concurrency app1:5 -a app1 runserver'.split())
+        settings = djangomini.make_settings(options, django_options)
+
+        self.assertEqual(settings['MIDDLEWARE_CLASSES'][0], 'djangomini.ConcurrencyLimitMiddleware')
+        self.assertEqual(settings['CONCURRENCY_LIMITS'], {'app1': 5})
+
+    def test_workers_share_limit(self):
+        # With several workers, each gets its share of the limit.
+        options, django_options, arguments = djangomini.parse_args(
+            '--concurrency app1:8 --concurrency app2:1 --workers 4 -a app1'.split())
+        settings = djangomini.make_settings(options, django_options)
+
+        self.assertEqual(settings['CONCURRENCY_LIMITS'], {'app1': 2, 'app2': 1})
+
+
+class TaskTests(BaseTest):
+    def tearDown(self):
+        djangomini._tasks.pop('tests.example_task', None)
+        super(TaskTests, self).tearDown()
+
+    def make_saved_task(self, **attrs):
+        defaults = {'pk': 1, 'name': 'tests.example_task', 'arguments': '[[1], {"b": 2}]',
+            'attempts': 0, 'retries': 0, 'retry_delay': 1.0, 'status': 'running'}
+        defaults.update(attrs)
+        name = defaults.pop('name')
+        saved_task = Mock(**defaults)
+        # Mock(name=...) names the mock instead of setting the attribute.
+        saved_task.name = name
+        return saved_task
+
+    @patch('djangomini.enqueue')
+    def test_task_decorator(self, enqueue):
+        # Decorated functions are registered and get a delay() method.
+        def example_task(a, b=None):
+            return a, b
+        # The same name however the tests are run.
+        example_task.__module__ = 'tests'
+        example_task = djangomini.task(retries=2)(example_task)
+
+        self.assertTrue(djangomini.find_task('tests.example_task') is example_task)
+        self.assertEqual(example_task(1, b=2), (1, 2))
+
+        example_task.delay(1, b=2)
+        enqueue.assert_called_once_with('tests.example_task', (1,), {'b': 2}, 2, 1.0)
+
+    def test_run_task(self):
+        # A task that succeeds is deleted.
+        func = Mock()
+        djangomini._tasks['tests.example_task'] = func
+        saved_task = self.make_saved_task()
+
+        self.assertTrue(djangomini.run_task(saved_task))
+        func.assert_called_once_with(1, b=2)
+        self.assertTrue(saved_task.delete.called)
+
+    @patch('djangomini._now')
+    @patch('djangomini.logging')
+    def test_run_task_retries(self, logging, now):
+        # A task that fails is retried later, until it runs out of retries.
+        import datetime
+
+        now.return_value = datetime.datetime(2013, 1, 1)
+        djangomini._tasks['tests.example_task'] = Mock(side_effect=ValueError)
+        saved_task = self.make_saved_task(retries=1, retry_delay=5.0)
+
+        self.assertFalse(djangomini.run_task(saved_task))
+        self.assertEqual(saved_task.status, 'pending')
+        self.assertEqual(saved_task.run_after, datetime.datetime(2013, 1, 1, 0, 0, 5))
+
+        djangomini.run_task(saved_task)
+        self.assertEqual(saved_task.status, 'failed')
+        self.assertEqual(saved_task.attempts, 2)
+        self.assertTrue('ValueError' in saved_task.error)
+        self.assertFalse(saved_task.delete.called)
+
+    @patch('djangomini.claim_tasks')
+    def test_worker_burst(self, claim_tasks):
+        # A burst worker stops when there are no more tasks.
+        djangomini.configure_settings({})
+        claim_tasks.return_value = []
+        worker = djangomini.TaskWorker(burst=True)
+        with patch('django.db.connection') as connection:
+            with patch('django.db.transaction') as transaction:
+                worker.run()
+
+        claim_tasks.assert_called_once_with(10, 300)
+        self.assertTrue(connection.close.called)
+        # Each poll ends its transaction.
+        self.assertTrue(transaction.commit_unless_managed.called)
+
+    @patch('djangomini.logging')
+    @patch('djangomini.run_task')
+    @patch('djangomini.claim_tasks')
+    def test_worker_survives_errors(self, claim_tasks, run_task, logging):
+        # An error saving a task's result is logged, and the worker goes on.
+        djangomini.configure_settings({})
+        claim_tasks.side_effect = [[self.make_saved_task(), self.make_saved_task(pk=2)], []]
+        run_task.side_effect = [ValueError, True]
+        worker = djangomini.TaskWorker(burst=True)
+        with patch('django.db.connection'):
+            with patch('django.db.transaction') as transaction:
+                worker.run()
+
+        self.assertEqual(run_task.call_count, 2)
+        self.assertEqual(claim_tasks.call_count, 2)
+        self.assertTrue(logging.exception.called)
+        self.assertTrue(transaction.rollback_unless_managed.called)
+
+    @patch('djangomini._now')
+    @patch('djangomini.get_task_model')
+    @patch('djangomini.create_task_table')
+    def test_enqueue_creates_table(self, create_task_table, get_task_model, now):
+        # The table is made before the first task is saved.
+        with patch('djangomini._task_table_exists', False):
+            djangomini.enqueue('tests.example_task', (1,))
+        self.assertTrue(create_task_table.called)
+
+    def test_is_reloader_parent(self):
+        # Only the autoreloading runserver's watching process is the parent.
+        with patch.dict('os.environ', {'RUN_MAIN': ''}):
+            self.assertTrue(djangomini.is_reloader_parent(['runserver', '8080']))
+            self.assertFalse(djangomini.is_reloader_parent(['runserver', '--noreload']))
+            self.assertFalse(djangomini.is_reloader_parent(['shell']))
+            self.assertFalse(djangomini.is_reloader_parent([]))
+        with patch.dict('os.environ', {'RUN_MAIN': 'true'}):
+            self.assertFalse(djangomini.is_reloader_parent(['runserver']))
+
+
+class ExportTests(BaseTest):
+    def test_stream_json(self):
+        import json
+
+        djangomini.configure_settings({})
+        result = ''.join(djangomini.stream_json(['id', 'name'], iter([(1, 'a'), (2, 'b')])))
+        self.assertEqual(json.loads(result), [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}])
+        self.assertEqual(''.join(djangomini.stream_json(['id'], iter([]))), '[]\n')
+
+    def test_stream_csv(self):
+        result = list(djangomini.stream_csv(['id', 'name'], iter([(1, 'a,b')])))
+        self.assertEqual(result, ['id,name\r\n', '1,"a,b"\r\n'])
+
+    def test_is_streaming(self):
+        self.assertTrue(djangomini.is_streaming(Mock(streaming=True)))
+        self.assertFalse(djangomini.is_streaming(Mock(streaming=False,
+            _base_content_is_iter=False, _is_string=True)))
+        # Before Django 1.5 a response made with an iterator streams.
+        with patch('django.VERSION', (1, 4, 0, 'final', 0)):
+            self.assertTrue(djangomini.is_streaming(Mock(streaming=False,
+                _base_content_is_iter=True)))
+
+    def test_stream_csv_text(self):
+        # Text is written as UTF-8.
+        result = list(djangomini.stream_csv(['name'], iter([(u'caf\xe9',)])))
+        self.assertEqual(result[1], u'caf\xe9\r\n'.encode('utf-8')
+            if str is bytes else u'caf\xe9\r\n')
+
+    def test_make_export_urlpatterns(self):
+        # Each app's models are exported under its app label.
+        djangomini.configure_settings({})
+        patterns = djangomini.make_export_urlpatterns(['myproject.app1'])
+        match = patterns[0].resolve('export/app1/flavour.csv')
+
+        self.assertEqual(match.kwargs, {'app_label': 'app1', 'model_name': 'flavour',
+            'format': 'csv'})
+        self.assertEqual(patterns[0].resolve('export/app2/flavour.csv'), None)
+
+
+class BenchmarkCompareTests(unittest.TestCase):
+    def test_compare_results(self):
+        # Only results worse than the baseline by more than the threshold fail.
+        import benchmarks
+
+        def result(value, higher_is_better):
+            return {'value': value, 'unit': '', 'higher_is_better': higher_is_better}
+
+        baseline = {'rate': result(100, True), 'time': result(1.0, False),
+            'slower': result(100, True), 'longer': result(1.0, False)}
+        results = {'rate': result(85, True), 'time': result(1.15, False),
+            'slower': result(70, True), 'longer': result(1.5, False),
+            'new': result(1, True)}
+
+        regressions = benchmarks.compare_results(baseline, results, 0.2)
+        self.assertEqual([r[0] for r in regressions], ['longer', 'slower'])
+
+    def test_compare_results_spread(self):
+        # A change within the spread of the measurements is noise.
+        import benchmarks
+
+        baseline = {'rate': {'value': 100, 'spread': 0.05, 'higher_is_better': True}}
+        results = {'rate': {'value': 78, 'spread': 0.1, 'higher_is_better': True}}
+        self.assertEqual(benchmarks.compare_results(baseline, results, 0.2), [])
+
+        results['rate']['value'] = 69
+        self.assertEqual(len(benchmarks.compare_results(baseline, results, 0.2)), 1)
+
+    def test_summarize(self):
+        import benchmarks
+
+        self.assertEqual(benchmarks.summarize([110, 90, 100, 105, 95]), (100, 0.2))
+
+
 class CustomAppsTests(BaseTest):
     def test_admin_app(self):
         # django.contrib.admin